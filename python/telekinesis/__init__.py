@@ -1,6 +1,7 @@
 from .client import Session, Connection, Channel, Route
-from .broker import Broker
-from .telekinesis import Telekinesis, inject_first_arg, State
+from .broker import Broker, BrokerWorkers
+from .metrics import Metrics
+from .telekinesis import Telekinesis, inject_first_arg, memoize, State, Cache, Executor, Stream
 from .helpers import PublicUser, authenticate
 
 from pkg_resources import get_distribution
@@ -11,6 +12,8 @@ __all__ = [
     "__version__",
     "Telekinesis",
     "Broker",
+    "BrokerWorkers",
+    "Metrics",
     "PublicUser",
     "authenticate",
     "Session",
@@ -18,5 +21,9 @@ __all__ = [
     "Channel",
     "Route",
     "inject_first_arg",
+    "memoize",
     "State",
+    "Cache",
+    "Executor",
+    "Stream",
 ]
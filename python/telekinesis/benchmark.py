@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import ujson
+
+from .broker import Broker
+from .client import Connection, Session
+from .telekinesis import Telekinesis
+
+
+async def run_broker_benchmark(
+    n_brokers=1, n_sessions=10, message_size=1024, rate=None, duration=5, concurrency=1, host="127.0.0.1", port=8900,
+):
+    # Brokers run in their own processes so their CPU and memory are not mixed with the clients'
+    context = multiprocessing.get_context("spawn")
+    processes, pipes, connections = [], [], []
+    loop = asyncio.get_event_loop()
+
+    async def connect(i):
+        connection = await Connection(Session(), f"ws://{host}:{port + i % n_brokers}")
+        connections.append(connection)
+        return connection.session
+
+    try:
+        for i in range(n_brokers):
+            pipe, child_pipe = context.Pipe()
+            peers = [f"ws://{host}:{port + j}" for j in range(i)]
+            processes.append(context.Process(target=run_broker, args=(host, port + i, peers, child_pipe), daemon=True))
+            processes[-1].start()
+            pipes.append(pipe)
+            await loop.run_in_executor(None, receive, pipe)
+        await asyncio.sleep(0.1 * n_brokers)
+
+        # Each sender calls an echo owned by a session on the next broker, so meshes route every message through a peer
+        receivers = [await connect(i) for i in range(n_brokers)]
+        senders = [await connect(i) for i in range(n_sessions)]
+        echoes = []
+        for i, sender in enumerate(senders):
+            route = Telekinesis(echo, receivers[(i + 1) % n_brokers])._delegate(sender.session_key.public_serial())
+            echoes.append(await asyncio.wait_for(Telekinesis(route, sender), 15))
+
+        payload = os.urandom(message_size)
+        latencies = []
+        errors = [0]
+
+        async def drive(remote_echo, deadline):
+            while time.time() < deadline:
+                t = time.time()
+                try:
+                    await asyncio.wait_for(remote_echo(payload), 15)
+                    latencies.append(time.time() - t)
+                except Exception:
+                    errors[0] += 1
+                if rate:
+                    await asyncio.sleep(max(0, concurrency / rate - (time.time() - t)))
+
+        for pipe in pipes:
+            pipe.send("start")
+        usage, t0 = resource.getrusage(resource.RUSAGE_SELF), time.time()
+        deadline = t0 + duration
+        await asyncio.gather(*(drive(e, deadline) for e in echoes for _ in range(concurrency)))
+        elapsed = time.time() - t0
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        for pipe in pipes:
+            pipe.send("stop")
+        broker_usage = [await loop.run_in_executor(None, receive, pipe) for pipe in pipes]
+    finally:
+        for connection in connections:
+            connection.listener.cancel()
+            if connection.websocket:
+                await connection.websocket.close()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    return {
+        "benchmark": "broker",
+        "config": {
+            "n_brokers": n_brokers,
+            "n_sessions": n_sessions,
+            "message_size": message_size,
+            "rate": rate,
+            "duration": duration,
+            "concurrency": concurrency,
+        },
+        "messages": len(latencies),
+        "errors": errors[0],
+        "throughput": len(latencies) / elapsed,
+        "throughput_bytes": 2 * message_size * len(latencies) / elapsed,
+        "latency": summarize(latencies),
+        "cpu_seconds": (usage_end.ru_utime + usage_end.ru_stime) - (usage.ru_utime + usage.ru_stime),
+        "max_rss_kb": usage_end.ru_maxrss,
+        "rss_kb": current_rss_kb(),
+        "brokers": broker_usage,
+    }
+
+
+def run_broker(host, port, peers, pipe):
+    async def serve():
+        broker = await Broker().serve(host, port)
+        try:
+            for url in peers:
+                await broker.add_broker(url)
+            pipe.send("ready")
+            await loop.run_in_executor(None, pipe.recv)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            await loop.run_in_executor(None, pipe.recv)
+            usage_end = resource.getrusage(resource.RUSAGE_SELF)
+            metrics = broker.metrics.to_dict()
+            pipe.send({
+                "cpu_seconds": (usage_end.ru_utime + usage_end.ru_stime) - (usage.ru_utime + usage.ru_stime),
+                "max_rss_kb": usage_end.ru_maxrss,
+                "rss_kb": current_rss_kb(),
+                "metrics": {name: metrics.get(name) for name in ["replay_rejects_total", "expect_channel_timeouts_total"]},
+            })
+        finally:
+            await broker.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve())
+
+
+def receive(pipe, timeout=30):
+    if not pipe.poll(timeout):
+        raise TimeoutError("Broker process did not respond")
+    return pipe.recv()
+
+
+def echo(x):
+    return x
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "p999": percentile(values, 99.9),
+        "max": max(values) if values else None,
+    }
+
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def compare(result, baseline, path=""):
+    out = {}
+    for key, value in result.items():
+        if key == "config" or key not in baseline:
+            continue
+        if isinstance(value, dict) and isinstance(baseline[key], dict):
+            out.update(compare(value, baseline[key], path + key + "."))
+        elif type(value) in (int, float) and type(baseline[key]) in (int, float) and baseline[key]:
+            out[path + key] = {"baseline": baseline[key], "current": value, "ratio": value / baseline[key]}
+    return out
+
+
+def report(result, output=None, baseline=None):
+    if baseline:
+        with open(baseline) as f:
+            result["comparison"] = compare(result, ujson.load(f))
+    text = ujson.dumps(result, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Broker load benchmark")
+    parser.add_argument("--brokers", type=int, default=1)
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--size", type=int, default=1024, help="message size in bytes")
+    parser.add_argument("--rate", type=float, default=None, help="messages per second per session, unlimited if omitted")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=1, help="calls in flight per session")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    args = parser.parse_args(argv)
+
+    result = asyncio.get_event_loop().run_until_complete(
+        run_broker_benchmark(
+            args.brokers, args.sessions, args.size, args.rate, args.duration, args.concurrency, port=args.port,
+        )
+    )
+    sys.stdout.write(report(result, args.output, args.baseline) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,49 @@
 import logging
 import os
+import base64
+import hmac
 import asyncio
 import time
+import multiprocessing
+import shutil
+import tempfile
+import zlib
 from packaging import version
 import re
 from pkg_resources import get_distribution
 
+import bson
 import ujson
-import websockets
 
-from .cryptography import PrivateKey, PublicKey, Token
-from .client import Route
+from .cryptography import PrivateKey, PublicKey, SharedKey, Token, InvalidSignature
+from .transport import connect, serve
+from .client import Route, FRAMING_VERSION, V2_SENTINEL, frame_prefix, frame_lengths
+from .metrics import Metrics
+from .timers import Timers, resolve
 
 
 class Connection:
-    def __init__(self, websocket):
+    def __init__(self, websocket, max_queue_size=1000, overflow="block", max_parallel=None, ordered=False):
         self.MIN_CLIENT_VERSION = "0.1.0a20"
         self.websocket = websocket
         self.logger = logging.getLogger(__name__)
         self.session = None
         self.channels = set()
         self.tasks = set()
-
-    async def handshake(self, sessions, broker_key, entrypoint):
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.outbox = None
+        self.writer = None
+        self.stats = {"sent": 0, "dropped": 0, "max_depth": 0}
+        self.semaphore = max_parallel and asyncio.Semaphore(max_parallel)
+        self.ordered = ordered
+        self.ordered_tasks = {}
+        self.dispatch_stats = {"received": 0, "processed": 0, "failed": 0, "max_in_flight": 0}
+        self.ticket = None
+        self.resumed = False
+        self.framing = 1
+
+    async def handshake(self, sessions, broker_key, entrypoint, tickets=None, ticket_ttl=30):
         challenge = os.urandom(32) + int(time.time()).to_bytes(4, "big")
 
         await self.websocket.send(challenge)
@@ -36,12 +57,32 @@ class Connection:
             await self.websocket.send(err_message.encode())
             raise Exception(err_message)
 
-        PublicKey(session_id).verify(signature, challenge)
+        self.framing = min(metadata.get("framing", 1), FRAMING_VERSION)
+        resume = metadata.get("resume") or {}
+        ticket = tickets and tickets.get(resume.get("ticket"))
+        reply_metadata = {"entrypoint": entrypoint and entrypoint.to_dict(), "framing": FRAMING_VERSION}
+        if (
+            ticket and ticket["session_id"] == session_id and session_id in sessions
+            and (ticket["connection"] or ticket["expires"] > time.time())
+            and hmac.compare_digest(hmac.new(ticket["secret"], challenge, "sha256").hexdigest(), resume.get("proof", ""))
+        ):  # The ticket secret proves the identity, so neither side needs ECDSA
+            self.resumed = True
+            proof = hmac.new(ticket["secret"], client_challenge, "sha256").digest() + b"\x00" * 32
+            reply_metadata["resumed"] = True
+        else:
+            PublicKey(session_id).verify(signature, challenge)
+            proof = broker_key.sign(client_challenge)
+            ticket = None
+            if tickets is not None and metadata.get("resumable"):
+                secret, nonce = os.urandom(32), os.urandom(16)
+                ticket = {"session_id": session_id, "secret": secret, "ttl": ticket_ttl, "channels": []}
+                ticket["id"] = base64.b64encode(os.urandom(24)).decode()
+                tickets[ticket["id"]] = ticket
+                encrypted = SharedKey(broker_key, PublicKey(session_id)).encrypt(secret, nonce)
+                reply_metadata["ticket"] = {"id": ticket["id"], "secret": base64.b64encode(nonce + encrypted).decode()}
 
         await self.websocket.send(
-            broker_key.sign(client_challenge)
-            + broker_key.public_serial().encode()
-            + ujson.dumps({"entrypoint": entrypoint and entrypoint.to_dict()}, escape_forward_slashes=False).encode()
+            proof + broker_key.public_serial().encode() + ujson.dumps(reply_metadata, escape_forward_slashes=False).encode()
         )
 
         if session_id not in sessions:
@@ -50,31 +91,134 @@ class Connection:
         self.session = sessions[session_id]
         self.session.connections.add(self)
 
+        if self.resumed and ticket["connection"]:  # The previous connection hasn't timed out yet
+            ticket["channels"] = [c.channel_id for c in ticket["connection"].channels]
+        if ticket:
+            if ticket.get("timer"):
+                ticket.pop("timer").cancel()
+            ticket["connection"] = self
+            self.ticket = ticket
+        if self.resumed:
+            for channel_id in ticket["channels"]:
+                if channel_id in self.session.channels:
+                    channel = self.session.channels[channel_id]
+                    channel.connections.add(self)
+                    self.channels.add(channel)
+                    future = self.session.expecting_channels.pop(channel_id, None)
+                    if future:
+                        resolve(future, True)
+
         return self
 
+    async def enqueue(self, message):
+        if self.outbox is None:
+            self.outbox = asyncio.Queue(self.max_queue_size)
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.get_event_loop().create_task(self.write())
+
+        if self.framing < 2 and message[68:70] == V2_SENTINEL:  # Frames over the v1 size limits can't be parsed
+            self.stats["dropped"] += 1
+            self.logger.info("%s: dropped v2 frame for a v1 connection", self.session and self.session.session_id[:4])
+            return
+
+        if self.outbox.full() and self.overflow != "block":
+            self.stats["dropped"] += 1
+            if self.overflow == "drop_oldest":
+                self.outbox.get_nowait()
+            else:  # "disconnect"
+                self.logger.info("%s: outbound queue full, disconnecting", self.session and self.session.session_id[:4])
+                await self.websocket.close()
+                return
+
+        await self.outbox.put(message)
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.outbox.qsize())
+
+    async def write(self):
+        while True:
+            message = await self.outbox.get()
+            try:
+                await self.websocket.send(message)
+                self.stats["sent"] += 1
+            except Exception:
+                self.stats["dropped"] += 1
+                self.logger.info("%s: failed to send message", self.session and self.session.session_id[:4], exc_info=True)
+
+    def is_connected(self):
+        return self.websocket is not None and not self.websocket.closed
+
+    async def stop_writer(self):
+        if self.writer is not None and not self.writer.done():
+            self.writer.cancel()
+            await asyncio.wait([self.writer])
+        self.writer, self.outbox = None, None
+
+    def dispatch(self, handler, *args, key=None):
+        previous = self.ordered_tasks.get(key) if key is not None else None
+        task = asyncio.get_event_loop().create_task(self.run(previous, handler, *args))
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        if key is not None:
+            self.ordered_tasks[key] = task
+            task.add_done_callback(lambda t: self.ordered_tasks.get(key) is t and self.ordered_tasks.pop(key))
+
+        self.dispatch_stats["received"] += 1
+        self.dispatch_stats["max_in_flight"] = max(self.dispatch_stats["max_in_flight"], len(self.tasks))
+
+    async def run(self, previous, handler, *args):
+        if previous:
+            await asyncio.wait([previous])
+        if self.semaphore:
+            async with self.semaphore:
+                return await handler(*args)
+        return await handler(*args)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        if task.exception():
+            self.dispatch_stats["failed"] += 1
+            self.logger.error("Error processing message", exc_info=task.exception())
+        else:
+            self.dispatch_stats["processed"] += 1
+
+    def queue_stats(self):
+        return dict(self.stats, depth=self.outbox.qsize() if self.outbox else 0, overflow=self.overflow)
+
     async def close(self, sessions, remove=True):
+        retain = self.ticket is not None and self.ticket["connection"] is self
+        if retain:  # The session keeps its channels and tokens until the ticket expires
+            self.ticket.update(
+                connection=None, expires=time.time() + self.ticket["ttl"], channels=[c.channel_id for c in self.channels]
+            )
         try:
-            await self.websocket.close()
+            if self.writer:
+                self.writer.cancel()
+            if self.websocket:  # Peers that never connected have no websocket
+                await self.websocket.close()
             for channel in self.channels:
                 if self in channel.connections:
                     channel.connections.remove(self)
-                if not channel.connections:
+                    channel.last_active = time.time()
+                if not channel.connections and not retain:
                     self.session.channels.pop(channel.channel_id, None)
 
             if remove:
                 if self in self.session.connections:
                     self.session.connections.remove(self)
+                    self.session.last_active = time.time()
 
                 self.session.broker_connections.pop(self, None)
 
-                if not self.session.channels and not self.session.broker_connections and not self.session.connections:
+                if (
+                    not retain and not self.session.channels and not self.session.broker_connections
+                    and not self.session.connections
+                ):
                     sessions.pop(self.session.session_id, None)
 
-                await asyncio.gather(*(x for x in self.tasks if x.done()))
-                # print([x for x in self.tasks if not x.done()])
-                [x.cancel() for x in self.tasks if not x.done()]
+                [x.cancel() for x in list(self.tasks) if not x.done()]
         except Exception:
-            self.logger.error("Exception when closing %s", self.session.session_id[:4], exc_info=True)
+            self.logger.error("Exception when closing %s", self.session and self.session.session_id[:4], exc_info=True)
 
 
 class Session:
@@ -87,50 +231,67 @@ class Session:
         self.active_tokens = {}
         self.cached_tokens = {}
         self.expecting_tokens = {}
-        self.tasks = set()
+        self.cached_token_timers = {}
+        self.last_active = time.time()
 
-    async def validate_peer_token(self, token, event):
+    async def validate_peer_token(self, token, future):
         if token.signature in self.cached_tokens and token.encode() == self.cached_tokens[token.signature].encode():
-            event.set()
+            resolve(future, True)
             return True
-        self.expecting_tokens[token.signature] = (event, token)
+        self.expect_token(token, future)
         for broker in self.broker_connections.values():
             await broker.send((("token", ("validate", token.encode())),))
-        self.tasks.add(asyncio.get_event_loop().create_task(self.clean_expecting_token(token)))
 
         return False
 
-    async def clean_expecting_token(self, token):
-        await asyncio.sleep(2)
-        self.expecting_tokens.pop(token.signature, None)
+    def broker_connection(self):
+        # Peer links that are reconnecting stay in broker_connections, a connected one is preferred
+        peers = list(self.broker_connections.values())
+        return next((peer for peer in peers if peer.is_connected()), peers[0] if peers else None)
+
+    def expect_token(self, token, future):
+        def forget(_):
+            if self.expecting_tokens.get(token.signature, (None,))[0] is future:
+                self.expecting_tokens.pop(token.signature)
+
+        self.expecting_tokens[token.signature] = (future, token)
+        future.add_done_callback(forget)  # The validation's timer resolves it if no approval arrives
 
-    async def timeout_cached_token(self, token):
-        await asyncio.sleep(15)
-        self.cached_tokens.pop(token.signature, None)
+    def expire_cached_token(self, signature):
+        self.cached_token_timers.pop(signature, None)
+        self.cached_tokens.pop(signature, None)
 
     def approve_token(self, token):
-        self.tasks = set(x for x in self.tasks if not x.done())
         if token.issuer == self.session_id:
             self.active_tokens[token.signature] = token
         else:
             self.cached_tokens[token.signature] = token
-            self.tasks.add(asyncio.get_event_loop().create_task(self.timeout_cached_token(token)))
+            if token.signature in self.cached_token_timers:
+                self.cached_token_timers[token.signature].cancel()
+            self.cached_token_timers[token.signature] = Timers.get().call_later(
+                15, self.expire_cached_token, token.signature
+            )
 
-        event, expected_token = self.expecting_tokens.get(token.signature, (None, None))
+        future, expected_token = self.expecting_tokens.get(token.signature, (None, None))
         if expected_token and expected_token.encode() == token.encode():
             self.expecting_tokens.pop(token.signature, None)
-            event.set()
+            resolve(future, True)
 
     async def expect_channel(self, channel_id):
-        if channel_id not in self.channels:
-            list(self.connections)[0].logger.info("awaiting channel %s", channel_id[:4])
-            event = asyncio.Event()
-            self.expecting_channels[channel_id] = event
-            try:
-                await asyncio.wait_for(event.wait(), 2)
-                self.expecting_channels.pop(channel_id, None)
-            except asyncio.exceptions.TimeoutError:
-                pass
+        if channel_id not in self.channels or not self.channels[channel_id].connections:
+            logging.getLogger(__name__).info("awaiting channel %s", channel_id[:4])
+            future = self.expecting_channels.get(channel_id)
+            if future is None:  # Concurrent sends to the same channel share one wait
+                future = self.expecting_channels[channel_id] = asyncio.get_event_loop().create_future()
+                timer = Timers.get().call_later(2, resolve, future, False)
+
+                def forget(_):
+                    timer.cancel()
+                    if self.expecting_channels.get(channel_id) is future:
+                        self.expecting_channels.pop(channel_id)
+
+                future.add_done_callback(forget)
+            await asyncio.shield(future)  # A cancelled sender must not cancel the others waiting on the channel
         return self.channels.get(channel_id)
 
 
@@ -140,6 +301,7 @@ class Channel:
         self.channel_id = channel_id
         self.is_public = is_public
         self.connections = set()
+        self.last_active = time.time()
 
     def close(self):
         for connection in self.connections:
@@ -177,25 +339,66 @@ class Channel:
 
 
 class Broker:
-    def __init__(self, broker_key_file=None):
+    def __init__(
+        self, broker_key_file=None, max_queue_size=1000, overflow="block", max_parallel=None, ordered=False, metrics=None,
+        snapshot_file=None, snapshot_interval=10, gc_interval=30, idle_ttl=60,
+    ):
         self.sessions = {}
         self.servers = {}
         self.entrypoint = None
         self.broker_key = PrivateKey(broker_key_file)
         self.logger = logging.getLogger(__name__)
         self.seen_messages = [set(), set(), 0]
+        self.TOKEN_CACHE_TTL = 15  # sec, same as the peer approvals cached in Session.cached_tokens
+        self.NEGATIVE_TOKEN_CACHE_TTL = 1  # sec
+        self.MAX_TOKEN_CACHE_SIZE = 10000
+        self.token_cache = {}
+        self.token_validations = {}
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.max_parallel = max_parallel
+        self.ordered = ordered
+        self.routes = {}
+        self.announcement = None
+        self.ROUTE_BATCH_SIZE = 500  # sessions per route header, to stay within the v1 header size
+        self.tasks = set()
+        self.TICKET_TTL = 30  # sec, how long a disconnected session's state is kept for resumption
+        self.tickets = {}
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_task = None
+        self.journal_lock = None
+        self.gc_interval = gc_interval
+        self.idle_ttl = idle_ttl  # sec, before sessions and channels without connections are evicted
+        self.gc_task = None
+        self.metrics = metrics or Metrics()
+        self.metrics.gauge("sessions", lambda: [({}, len(self.sessions))])
+        self.metrics.gauge("queue_depth", lambda: [({"session": x["session"]}, x["depth"]) for x in self.queue_stats()])
+        self.metrics.gauge(
+            "tasks_in_flight", lambda: [({"session": x["session"]}, x["in_flight"]) for x in self.dispatch_stats()]
+        )
+        self.metrics.gauge("table_size", lambda: [({"table": k}, v) for k, v in self.table_sizes().items()])
+        if snapshot_file:
+            self.restore_snapshot()
 
     async def handle_connection(self, websocket, _):
         connection = None
         try:
-            connection = await Connection(websocket).handshake(self.sessions, self.broker_key, self.entrypoint)
-            self.logger.info("%s: new connection %s", self.broker_key.public_serial()[:4], connection.session.session_id[:4])
+            connection = await Connection(
+                websocket, self.max_queue_size, self.overflow, self.max_parallel, self.ordered
+            ).handshake(self.sessions, self.broker_key, self.entrypoint, self.tickets, self.TICKET_TTL)
+            self.logger.info(
+                "%s: %s connection %s",
+                self.broker_key.public_serial()[:4],
+                "resumed" if connection.resumed else "new",
+                connection.session.session_id[:4],
+            )
+            self.metrics.inc("connections_total", resumed=connection.resumed)
 
             async for message in websocket:
-                if self.check_no_repeat(message):
-                    await asyncio.gather(*(x for x in connection.tasks if x.done()))
-                    connection.tasks = set(x for x in connection.tasks if not x.done())
-                    connection.tasks.add(asyncio.get_event_loop().create_task(self.handle_message(connection, message)))
+                # Frames forwarded by peers keep the timestamp of the broker they entered through, which has its own clock
+                if self.check_no_repeat(message, connection not in connection.session.broker_connections):
+                    self.dispatch_message(connection, message)
 
         except Exception:
             if connection:
@@ -212,17 +415,67 @@ class Broker:
             if connection:
                 self.logger.info("%s: %s disconnected", self.broker_key.public_serial()[:4], connection.session.session_id[:4])
                 await connection.close(self.sessions)
+                if connection.session.session_id not in self.sessions:
+                    self.announce_routes(remove=[connection.session.session_id])
+                if connection.ticket and not connection.ticket["connection"]:
+                    if connection.session.session_id in self.routes:  # Already reconnected through another broker
+                        self.release_tickets(connection.session.session_id)
+                    else:
+                        connection.ticket["timer"] = Timers.get().call_later(
+                            self.TICKET_TTL, self.expire_ticket, connection.ticket["id"]
+                        )
 
-    async def handle_message(self, connection, message):
+    def expire_ticket(self, ticket_id):
+        ticket = self.tickets.get(ticket_id)
+        if not ticket or ticket["connection"] or ticket["expires"] > time.time():
+            return
+        self.tickets.pop(ticket_id)
+        self.release_session(ticket["session_id"], ticket["channels"])
+
+    def release_tickets(self, session_id):
+        # A session that reconnected through another broker, like a sibling worker, can't resume here, so its state is stale
+        session = self.sessions.get(session_id)
+        if not session or session.connections:
+            return
+        for ticket_id, ticket in list(self.tickets.items()):
+            if ticket["session_id"] == session_id and not ticket["connection"]:
+                if ticket.get("timer"):
+                    ticket.pop("timer").cancel()
+                self.tickets.pop(ticket_id)
+                self.release_session(session_id, ticket["channels"])
+
+    def release_session(self, session_id, channel_ids):
+        session = self.sessions.get(session_id)
+        if session:
+            for channel_id in channel_ids:
+                if channel_id in session.channels and not session.channels[channel_id].connections:
+                    session.channels.pop(channel_id)
+            if not session.channels and not session.broker_connections and not session.connections:
+                self.sessions.pop(session_id)
+                self.announce_routes(remove=[session_id])
+
+    def dispatch_message(self, connection, message):
+        if not connection.ordered:
+            return connection.dispatch(self.handle_message, connection, message)
+
+        headers, key = self.decode_header(message), None
+        for action, args in headers:
+            if action == "send":  # Messages to the same channel are handled in the order they arrived
+                key = (args["destination"]["session"], args["destination"]["channel"])
+        connection.dispatch(self.handle_message, connection, message, headers, key=key)
+
+    async def handle_message(self, connection, message, headers=None):
         try:
-            headers = self.decode_header(message)
+            headers = headers or self.decode_header(message)
             for action, args in headers:
                 if action == "listen":
                     self.handle_listen(connection, **args)
                 if action == "token":
                     await self.handle_tokens(connection, *args)
                 if action == "broker":
-                    self.handle_broker_action(connection, args)
+                    await self.handle_broker_action(connection, args)
+                if action == "route":
+                    self.handle_route(connection, **args)
                 if action == "send":
                     await self.handle_send(connection, message, **args)
                 if action == "close":
@@ -239,72 +492,73 @@ class Broker:
             await connection.close(self.sessions)
 
     async def handle_send(self, connection, message, source, destination):
-        self.logger.info(
-            "%s: send %s %s ??? %s ??? %s %s",
-            self.broker_key.public_serial()[:4],
-            source["session"][:4],
-            source["channel"][:4],
-            str(len(message) // 2 ** 10),
-            destination["session"][:4],
-            destination["channel"][:4],
-        )
+        t = time.time()
+        self.log_send("???", message, source, destination)
+        self.metrics.inc("messages_total", session=source["session"])
+        self.metrics.inc("bytes_total", len(message), session=source["session"])
         s = Route(**source)
         d = Route(**destination)
 
         dest_session = self.sessions.get(d.session)
         if dest_session:
             dest_channel = await dest_session.expect_channel(d.channel)
+            if not dest_channel:
+                self.metrics.inc("expect_channel_timeouts_total")
 
             if dest_session.channels.get(d.channel):
                 if await dest_channel.validate_token_chain(s.session, d.tokens, self):
-                    self.logger.info(
-                        "%s: send %s %s >>> %s >>> %s %s",
-                        self.broker_key.public_serial()[:4],
-                        source["session"][:4],
-                        source["channel"][:4],
-                        str(len(message) // 2 ** 10),
-                        destination["session"][:4],
-                        destination["channel"][:4],
-                    )
-
-                    for connection in dest_channel.connections:
-                        await connection.websocket.send(message)
-                    return
+                    if dest_channel.connections:  # Retained and restored channels wait for their owner to reconnect
+                        self.log_send(">>>", message, source, destination)
+
+                        await asyncio.gather(*(connection.enqueue(message) for connection in dest_channel.connections))
+                        self.metrics.inc("delivered_messages_total", session=d.session)
+                        self.metrics.observe("forward_latency_seconds", time.time() - t, path="local")
+                        return
                 else:
-                    self.logger.info(
-                        "%s: send %s %s ||| %s ||| %s %s",
-                        self.broker_key.public_serial()[:4],
-                        source["session"][:4],
-                        source["channel"][:4],
-                        str(len(message) // 2 ** 10),
-                        destination["session"][:4],
-                        destination["channel"][:4],
-                    )
-
-        if d.brokers:
-            for broker_id in d.brokers:
-                if broker_id in self.sessions:
-                    for broker_connection in self.sessions[broker_id].broker_connections.values():
-                        for enc_token in d.tokens:
-                            token = Token.decode(enc_token, False)
-                            if (
-                                self.broker_key.public_serial() in token.brokers
-                                and token.issuer in self.sessions
-                                and token.signature in self.sessions[token.issuer].active_tokens
-                                and enc_token == self.sessions[token.issuer].active_tokens.get(token.signature).encode()
-                            ):
-                                await broker_connection.send((("token", ("approve", enc_token)),))
-                        await broker_connection.websocket.send(message)
-                        self.logger.info(
-                            "%s: send %s %s ))) %s ))) %s %s (%s)",
-                            self.broker_key.public_serial()[:4],
-                            source["session"][:4],
-                            source["channel"][:4],
-                            str(len(message) // 2 ** 10),
-                            destination["session"][:4],
-                            destination["channel"][:4],
-                            broker_id[:4],
-                        )
+                    self.log_send("|||", message, source, destination)
+                    self.metrics.inc("unauthorized_messages_total")
+
+        broker_id, broker_connection = self.next_hop(d, connection.session.session_id)
+        if broker_connection:
+            approvals = self.token_approvals(broker_connection, d.tokens)
+            if approvals:
+                await broker_connection.send(approvals)
+            await broker_connection.enqueue(message)
+            self.log_send(")))", message, source, destination, broker_id)
+            self.metrics.inc("forwarded_messages_total", broker=broker_id)
+            self.metrics.observe("forward_latency_seconds", time.time() - t, path="peer")
+        else:
+            self.log_send("xxx", message, source, destination)
+            self.metrics.inc("dropped_messages_total")
+
+    def log_send(self, arrow, message, source, destination, broker_id=None):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                "%s: send %s %s %s %s %s %s %s%s",
+                self.broker_key.public_serial()[:4],
+                source["session"][:4],
+                source["channel"][:4],
+                arrow,
+                str(len(message) // 2 ** 10),
+                arrow,
+                destination["session"][:4],
+                destination["channel"][:4],
+                broker_id and " (%s)" % broker_id[:4] or "",
+            )
+
+    def next_hop(self, destination, source_id):
+        # Brokers that announced the session come first, the brokers listed in the route are the fallback.
+        # A broker is only used while its link is down if no connected one is left.
+        fallback = None, None
+        for broker_id in list(self.routes.get(destination.session, ())) + list(destination.brokers or []):
+            if broker_id == source_id or broker_id not in self.sessions:
+                continue
+            peer = self.sessions[broker_id].broker_connection()
+            if peer and peer.is_connected():
+                return broker_id, peer
+            if peer and fallback[1] is None:
+                fallback = broker_id, peer
+        return fallback
 
     def handle_listen(self, connection, session, channel, brokers, is_public=False):
         if session == connection.session.session_id:
@@ -316,6 +570,8 @@ class Broker:
                 str(is_public),
             )
 
+            if not connection.session.channels:
+                self.announce_routes(add=[session])
             if channel not in connection.session.channels:
                 connection.session.channels[channel] = Channel(connection.session, channel, is_public)
 
@@ -323,9 +579,9 @@ class Broker:
             channel_obj.connections.add(connection)
             connection.channels.add(channel_obj)
 
-            event = connection.session.expecting_channels.pop(channel, None)
-            if event:
-                event.set()
+            future = connection.session.expecting_channels.pop(channel, None)
+            if future:
+                resolve(future, True)
 
     def handle_close(self, connection, session, channel, **kwargs):
         if session == connection.session.session_id:
@@ -357,8 +613,9 @@ class Broker:
                     str(token.receiver[:4]),
                     token.asset[:4],
                 )
-                if token.token_type == "root":
-                    connection.session.active_tokens[token.signature] = token
+                self.token_cache.pop(token.signature, None)
+                if token.token_type == "root":  # Also wakes validations of extensions replayed in a later batch
+                    connection.session.approve_token(token)
                 elif token.token_type == "extension":
                     prev_token = tokens[1]
                     if await self.check_token(prev_token):
@@ -375,6 +632,12 @@ class Broker:
                     str(token.signature[:4]),
                 )
                 connection.session.active_tokens.pop(token.signature, None)
+                self.token_cache.pop(token.signature, None)
+                await self.journal_revocation(token.signature)
+                await self.revoke_peer_approvals(token.signature)
+            elif connection in connection.session.broker_connections:  # The peer broker approved this token earlier
+                connection.session.cached_tokens.pop(args[0], None)
+                self.token_cache.pop(args[0], None)
 
         if action == "validate":
             token = Token.decode(args[0], False)
@@ -389,6 +652,10 @@ class Broker:
                             action,
                             str(token.signature[:4]),
                         )
+                        # Like approvals sent with forwarded messages, so a revocation reaches the peer
+                        broker_connection.approved_tokens[token.signature] = (
+                            token.encode(), time.time() + broker_connection.APPROVAL_TTL
+                        )
                         await broker_connection.send((("token", ("approve", token.encode())),))
 
         if action == "approve":
@@ -400,47 +667,250 @@ class Broker:
                 action,
                 str(token.signature[:4]),
             )
+            self.token_cache.pop(token.signature, None)
             connection.session.approve_token(token)
 
-    def handle_broker_action(self, connection, action):
+    def token_approvals(self, peer, tokens):
+        now = time.time()
+        approvals = []
+        for enc_token in tokens:
+            signature = enc_token[: enc_token.find(".")]
+            approved_token, expires = peer.approved_tokens.get(signature, (None, 0))
+            if approved_token == enc_token and expires > now:
+                continue
+
+            token = Token.decode(enc_token, False)
+            if (
+                self.broker_key.public_serial() in token.brokers
+                and token.issuer in self.sessions
+                and token.signature in self.sessions[token.issuer].active_tokens
+                and enc_token == self.sessions[token.issuer].active_tokens.get(token.signature).encode()
+            ):
+                peer.approved_tokens[signature] = (enc_token, now + peer.APPROVAL_TTL)
+                approvals.append(("token", ("approve", enc_token)))
+        return approvals
+
+    async def revoke_peer_approvals(self, signature):
+        for session in list(self.sessions.values()):
+            for peer in list(session.broker_connections.values()):
+                if peer.approved_tokens.pop(signature, None):
+                    await peer.send((("token", ("revoke", signature)),))
+
+    async def handle_broker_action(self, connection, action):
         if action == "open":
-            connection.session.broker_connections[connection] = Peer(connection.websocket, self)
+            peer = Peer(connection.websocket, self)
+            peer.framing = connection.framing
+            connection.session.broker_connections[connection] = peer
+            for header in self.route_announcement():
+                await peer.send(header)
         if action == "close":
             connection.session.broker_sessions.pop(connection, None)
 
+    def handle_route(self, connection, add=(), remove=(), reset=False):
+        if connection not in connection.session.broker_connections:
+            return
+        peer_id = connection.session.session_id
+        if reset:
+            for session_id in [s for s, brokers in self.routes.items() if peer_id in brokers]:
+                self.remove_route(session_id, peer_id)
+        for session_id in add:
+            self.routes.setdefault(session_id, set()).add(peer_id)
+            self.release_tickets(session_id)
+        for session_id in remove:
+            self.remove_route(session_id, peer_id)
+
+    def remove_route(self, session_id, broker_id):
+        brokers = self.routes.get(session_id, set())
+        brokers.discard(broker_id)
+        if not brokers:
+            self.routes.pop(session_id, None)
+
+    def route_announcement(self):
+        local_sessions = [s.session_id for s in self.sessions.values() if s.channels and not s.broker_connections]
+        n = self.ROUTE_BATCH_SIZE
+        return [
+            (("route", {"add": local_sessions[i: i + n], "reset": i == 0}),) for i in range(0, max(1, len(local_sessions)), n)
+        ]
+
+    def announce_routes(self, add=(), remove=()):
+        async def announce(previous):
+            if previous:
+                await asyncio.wait([previous])  # Peers must apply announcements in the order they were made
+            for session in list(self.sessions.values()):
+                if session.broker_connections:
+                    await session.broker_connection().send((("route", {"add": add, "remove": remove}),))
+
+        task = self.announcement = asyncio.get_event_loop().create_task(announce(self.announcement))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
     async def add_broker(self, url, inherit_entrypoint=False):
         peer = Peer(None, self)
-        if re.sub(r'(?![\w\d]+:\/\/[\w\d.]+):[\d]+', '', url) == url:
+        if not url.startswith("unix://") and re.sub(r'(?![\w\d]+:\/\/[\w\d.]+):[\d]+', '', url) == url:
             i = len(re.findall(r'[\w\d]+:\/\/[\w\d.]+', url)[0])
             url = url[:i] + ':8776' + url[i:]
 
         await peer.connect(url, inherit_entrypoint)  # This already adds the peer to self.sessions
 
+    def clock_offset(self, token):
+        # valid_until is stamped in the clock of the issuer's brokers, which differs from ours by the peer's t_offset
+        if self.broker_key.public_serial() not in token.brokers:
+            for broker_id in token.brokers:
+                for peer in (broker_id in self.sessions and self.sessions[broker_id].broker_connections.values()) or ():
+                    return peer.t_offset
+        return 0
+
     async def check_token(self, token):
+        if token.valid_until and token.valid_until < time.time() - self.clock_offset(token):
+            return False
+
         session = self.sessions.get(token.issuer)
-        if session:
-            if token.signature in session.active_tokens:
-                return token.encode() == session.active_tokens.get(token.signature).encode()
-            else:
-                event = asyncio.Event()
-                session.expecting_tokens[token.signature] = (event, token)
-                session.tasks.add(asyncio.get_event_loop().create_task(session.clean_expecting_token(token)))
-                await asyncio.wait_for(event.wait(), 2)
+        if session and token.signature in session.active_tokens:
+            return token.encode() == session.active_tokens.get(token.signature).encode()
 
-                return True
-        else:
-            event = asyncio.Event()
-            for broker in token.brokers:
-                if broker in self.sessions and await self.sessions[broker].validate_peer_token(token, event):
-                    break
-            else:
-                try:
-                    await asyncio.wait_for(event.wait(), 2)
-                except asyncio.exceptions.TimeoutError:
-                    return False
-            return True
+        enc_token = token.encode()
+        cached_enc_token, valid, expires = self.token_cache.get(token.signature, (None, False, 0))
+        if cached_enc_token == enc_token and expires > time.time():
+            return valid
+
+        # Concurrent sends with the same token share a single validation
+        if enc_token not in self.token_validations:
+            self.token_validations[enc_token] = asyncio.get_event_loop().create_task(self.validate_token(token))
+        return await asyncio.shield(self.token_validations[enc_token])
 
-    def check_no_repeat(self, message):
+    async def validate_token(self, token):
+        enc_token = token.encode()
+        try:
+            session = self.sessions.get(token.issuer)
+            future = asyncio.get_event_loop().create_future()
+            timer = Timers.get().call_later(2, resolve, future, False)
+            if session:
+                session.expect_token(token, future)
+            else:
+                for broker in token.brokers:
+                    if broker in self.sessions and await self.sessions[broker].validate_peer_token(token, future):
+                        break
+            t = time.time()
+            valid = await future
+            timer.cancel()
+            self.metrics.observe("token_validation_seconds", time.time() - t, valid=valid)
+
+            self.cache_token(token.signature, enc_token, valid)
+            return valid
+        finally:
+            self.token_validations.pop(enc_token, None)
+
+    def cache_token(self, signature, enc_token, valid):
+        now = time.time()
+        if len(self.token_cache) >= self.MAX_TOKEN_CACHE_SIZE:
+            self.token_cache = {k: v for k, v in self.token_cache.items() if v[2] > now}
+            while len(self.token_cache) >= self.MAX_TOKEN_CACHE_SIZE:
+                self.token_cache.pop(next(iter(self.token_cache)))
+
+        ttl = self.TOKEN_CACHE_TTL if valid else self.NEGATIVE_TOKEN_CACHE_TTL
+        self.token_cache[signature] = (enc_token, valid, now + ttl)
+
+    def collect_garbage(self):
+        now = time.time()
+        evicted = {
+            "active_tokens": 0, "cached_tokens": 0, "approved_tokens": 0, "channels": 0, "sessions": 0, "tickets": 0,
+            "token_cache": 0,
+        }
+
+        retained_sessions, retained_channels = set(), set()  # Kept for clients that can still resume
+        for ticket_id, ticket in list(self.tickets.items()):
+            if not ticket["connection"] and ticket["expires"] < now:
+                self.tickets.pop(ticket_id)
+                evicted["tickets"] += 1
+            elif not ticket["connection"]:
+                retained_sessions.add(ticket["session_id"])
+                retained_channels.update(ticket["channels"])
+
+        removed = []
+        for session_id, session in list(self.sessions.items()):
+            self.expire_tokens(session, now, evicted)
+            for channel_id, channel in list(session.channels.items()):
+                idle = not channel.connections and now - channel.last_active > self.idle_ttl
+                if idle and channel_id not in retained_channels:
+                    session.channels.pop(channel_id)
+                    evicted["channels"] += 1
+            if (
+                not session.connections and not session.broker_connections and not session.channels
+                and session_id not in retained_sessions and now - session.last_active > self.idle_ttl
+            ):
+                self.sessions.pop(session_id)
+                removed.append(session_id)
+                evicted["sessions"] += 1
+
+        n = len(self.token_cache)
+        self.token_cache = {k: v for k, v in self.token_cache.items() if v[2] > now}
+        evicted["token_cache"] = n - len(self.token_cache)
+        for session_id, brokers in list(self.routes.items()):
+            for broker_id in [b for b in brokers if b not in self.sessions]:
+                self.remove_route(session_id, broker_id)
+
+        if removed:
+            self.announce_routes(remove=removed)
+        self.metrics.prune("session", set(self.sessions).union(self.routes))  # Sessions also leave outside of GC
+        for table, n in evicted.items():
+            if n:
+                self.metrics.inc("gc_evictions_total", n, table=table)
+        return evicted
+
+    def expire_tokens(self, session, now, evicted):
+        for table in ["active_tokens", "cached_tokens"]:
+            tokens = getattr(session, table)
+            expired = [
+                k for k, token in tokens.items() if token.valid_until and token.valid_until < now - self.clock_offset(token)
+            ]
+            for signature in expired:
+                tokens.pop(signature)
+                self.token_cache.pop(signature, None)
+                evicted[table] += 1
+        for peer in session.broker_connections.values():
+            for signature in [k for k, (_, expires) in peer.approved_tokens.items() if expires < now]:
+                peer.approved_tokens.pop(signature)
+                evicted["approved_tokens"] += 1
+
+    async def collect_garbage_periodically(self):
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                self.collect_garbage()
+            except Exception:
+                self.logger.error("%s: garbage collection failed", self.broker_key.public_serial()[:4], exc_info=True)
+
+    def table_sizes(self):
+        sessions = list(self.sessions.values())
+        return {
+            "sessions": len(sessions),
+            "channels": sum(len(s.channels) for s in sessions),
+            "active_tokens": sum(len(s.active_tokens) for s in sessions),
+            "cached_tokens": sum(len(s.cached_tokens) for s in sessions),
+            "approved_tokens": sum(len(p.approved_tokens) for s in sessions for p in s.broker_connections.values()),
+            "expecting_tokens": sum(len(s.expecting_tokens) for s in sessions),
+            "token_cache": len(self.token_cache),
+            "tickets": len(self.tickets),
+            "routes": len(self.routes),
+            "timers": len(Timers.get()),
+            "seen_messages": len(self.seen_messages[0]) + len(self.seen_messages[1]),
+        }
+
+    def queue_stats(self):
+        return [
+            dict(connection.queue_stats(), session=session_id)
+            for session_id, session in self.sessions.items()
+            for connection in session.connections.union(session.broker_connections.values())
+        ]
+
+    def dispatch_stats(self):
+        return [
+            dict(connection.dispatch_stats, session=session_id, in_flight=len(connection.tasks))
+            for session_id, session in self.sessions.items()
+            for connection in session.connections.union(session.broker_connections.values())
+        ]
+
+    def check_no_repeat(self, message, check_time=True):
         signature, timestamp = message[:64], int.from_bytes(message[64:68], "big")
         now = int(time.time())
 
@@ -449,41 +919,165 @@ class Broker:
             self.seen_messages[lead % 2].clear()
             self.seen_messages[2] = lead
 
-        if (now - 60 + 4) <= timestamp <= now + 4:
+        if not check_time or (now - 60 + 4) <= timestamp <= now + 4:
             if signature not in self.seen_messages[0].union(self.seen_messages[1]):
                 self.seen_messages[lead % 2].add(signature)
                 return True
 
+        self.metrics.inc("replay_rejects_total")
         return False
 
     def decode_header(self, m):
-        header = ujson.loads(m[73: 73 + int.from_bytes(m[68:70], "big")])
+        offset, len_h, _ = frame_lengths(m)
+        header = ujson.loads(m[offset: offset + len_h])
         return header
 
-    async def serve(self, host="127.0.0.1", port=8776, **kwargs):
-        if "compression" not in kwargs:
-            kwargs["compression"] = None
-        server = await websockets.serve(self.handle_connection, host, port, **kwargs)
-        self.servers[(host, port)] = server
+    async def serve(self, host="127.0.0.1", port=8776, transport="websocket", path=None, **kwargs):
+        server = await serve(self.handle_connection, host, port, transport, path=path, **kwargs)
+        self.servers[(None, None, path) if path is not None else (host, port, None)] = server
+        if self.snapshot_file and not self.snapshot_task:
+            self.snapshot_task = asyncio.get_event_loop().create_task(self.snapshot_periodically())
+        if self.gc_interval and not self.gc_task:
+            self.gc_task = asyncio.get_event_loop().create_task(self.collect_garbage_periodically())
+
+        return self
 
+    async def serve_metrics(self, host="127.0.0.1", port=9776):
+        await self.metrics.serve(host, port)
         return self
 
-    async def close(self, host=None, port=None):
-        for server_host, server_port in self.servers:
+    async def close(self, host=None, port=None, path=None):
+        for server_host, server_port, server_path in list(self.servers):
             if not host or server_host == host:
                 if not port or server_port == port:
-                    await self.servers.pop((server_host, server_port)).close()
+                    if not path or server_path == path:
+                        server = self.servers.pop((server_host, server_port, server_path))
+                        server.close()
+                        await server.wait_closed()
+
+    def snapshot(self):
+        return {
+            "version": 1,
+            "broker_id": self.broker_key.public_serial(),
+            "time": time.time(),
+            "sessions": {
+                session_id: {
+                    "channels": {channel_id: channel.is_public for channel_id, channel in session.channels.items()},
+                    "active_tokens": [token.encode() for token in session.active_tokens.values()],
+                }
+                for session_id, session in self.sessions.items()
+                if not session.broker_connections
+            },
+            "routes": {session_id: list(brokers) for session_id, brokers in self.routes.items()},
+            "tickets": [
+                {
+                    "id": ticket["id"],
+                    "session_id": ticket["session_id"],
+                    "secret": self.seal_secret(ticket["secret"]),
+                    "ttl": ticket["ttl"],
+                    "channels": [c.channel_id for c in ticket["connection"].channels]
+                    if ticket["connection"] else ticket["channels"],
+                }
+                for ticket in self.tickets.values()
+            ],
+        }
+
+    def seal_secret(self, secret):
+        # Ticket secrets are stored encrypted with a key only this broker's private key can derive
+        nonce = os.urandom(16)
+        return nonce + SharedKey(self.broker_key, PublicKey(self.broker_key.public_serial())).encrypt(secret, nonce)
+
+    def unseal_secret(self, sealed):
+        return SharedKey(self.broker_key, PublicKey(self.broker_key.public_serial())).decrypt(sealed[16:], sealed[:16])
+
+    async def write_snapshot(self):
+        t = time.time()
+        loop = asyncio.get_event_loop()
+        journal = self.snapshot_file + ".revoked"
+        if self.journal_lock is None:
+            self.journal_lock = asyncio.Lock()
+        async with self.journal_lock:  # Revocations after this point go to a new journal
+            await loop.run_in_executor(None, rotate_journal, journal)
+            state = self.snapshot()
+
+        await loop.run_in_executor(None, write_snapshot_file, self.snapshot_file, state)
+        if os.path.exists(journal + ".old"):
+            os.remove(journal + ".old")
+        self.metrics.observe("snapshot_seconds", time.time() - t)
+
+    async def snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.write_snapshot()
+            except Exception:
+                self.logger.error("%s: snapshot failed", self.broker_key.public_serial()[:4], exc_info=True)
+
+    async def journal_revocation(self, signature):
+        if self.snapshot_file:
+            if self.journal_lock is None:
+                self.journal_lock = asyncio.Lock()
+            async with self.journal_lock:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, append_journal, self.snapshot_file + ".revoked", signature + "\n"
+                )
+
+    def restore_snapshot(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+        with open(self.snapshot_file, "rb") as f:
+            state = bson.loads(zlib.decompress(f.read()))
+
+        revoked = set()
+        for path in [self.snapshot_file + ".revoked.old", self.snapshot_file + ".revoked"]:
+            if os.path.exists(path):
+                with open(path) as f:
+                    revoked.update(f.read().split())
+
+        for session_id, session_state in state["sessions"].items():
+            session = self.sessions.setdefault(session_id, Session(session_id))
+            for channel_id, is_public in session_state["channels"].items():
+                session.channels[channel_id] = Channel(session, channel_id, is_public)
+            for enc_token in session_state["active_tokens"]:
+                try:
+                    token = Token.decode(enc_token)
+                except InvalidSignature:
+                    self.logger.error("%s: dropped a restored token with an invalid signature", session_id[:4])
+                    continue
+                if token.signature not in revoked and not (token.valid_until and token.valid_until < time.time()):
+                    session.active_tokens[token.signature] = token
+        for session_id, brokers in state["routes"].items():
+            self.routes[session_id] = set(brokers)
+
+        if state["broker_id"] == self.broker_key.public_serial():  # Clients only resume with the broker that issued the ticket
+            for ticket in state["tickets"]:
+                self.tickets[ticket["id"]] = dict(
+                    ticket, secret=self.unseal_secret(ticket["secret"]), connection=None, expires=time.time() + ticket["ttl"]
+                )
+                self.tickets[ticket["id"]]["timer"] = Timers.get().call_later(ticket["ttl"], self.expire_ticket, ticket["id"])
+        Timers.get().call_later(self.TICKET_TTL, self.release_restored, list(state["sessions"]))
+        self.logger.info(
+            "%s: restored %d sessions from %s", self.broker_key.public_serial()[:4], len(state["sessions"]), self.snapshot_file
+        )
+
+    def release_restored(self, session_ids):
+        resumable = set(ticket["session_id"] for ticket in self.tickets.values())
+        for session_id in session_ids:
+            if session_id not in resumable and session_id in self.sessions:
+                self.release_session(session_id, list(self.sessions[session_id].channels))
 
 
 class Peer(Connection):
     def __init__(self, websocket, broker):
-        super().__init__(websocket)
+        super().__init__(websocket, broker.max_queue_size, broker.overflow, broker.max_parallel, broker.ordered)
         self.broker = broker
         self.t_offset = 0
         self.listener = None
         self.url = None
         self.lock = asyncio.Event()
         self.exception = None
+        self.APPROVAL_TTL = 10  # sec, peers forget approved tokens after 15 sec
+        self.approved_tokens = {}
 
     def connect(self, url, inherit_entrypoint):
         self.url = url
@@ -492,10 +1086,11 @@ class Peer(Connection):
         return self
 
     async def reconnect(self):
+        await self.stop_writer()
         if self.websocket:
             await self.websocket.close()
 
-        self.websocket = await websockets.connect(self.url)
+        self.websocket = await connect(self.url)
 
         challenge = await self.websocket.recv()
         t_broker = int.from_bytes(challenge[-4:], "big")
@@ -506,7 +1101,7 @@ class Peer(Connection):
         pk = self.broker.broker_key.public_serial().encode()
 
         sent_challenge = os.urandom(32)
-        sent_metadata = {"version": get_distribution(__name__.split(".")[0]).version}
+        sent_metadata = {"version": get_distribution(__name__.split(".")[0]).version, "framing": FRAMING_VERSION}
         await self.websocket.send(signature + pk + sent_challenge + ujson.dumps(sent_metadata).encode())
 
         m = await asyncio.wait_for(self.websocket.recv(), 15)
@@ -518,18 +1113,21 @@ class Peer(Connection):
         PublicKey(session_id).verify(signature, sent_challenge)
 
         entrypoint = Route(**metadata.get("entrypoint")) if metadata.get("entrypoint") else None
+        self.framing = min(metadata.get("framing", 1), FRAMING_VERSION)
 
+        await self.stop_writer()  # Messages queued during the handshake would precede it
+        self.approved_tokens.clear()
         await self.send([("broker", "open")])
 
         return session_id, entrypoint
 
     async def send(self, header):
         h = ujson.dumps(header).encode()
-        m = len(h).to_bytes(2, "big") + (0).to_bytes(3, "big") + h
+        m = frame_prefix(len(h), 0, self.framing) + h
         t = int(time.time() - self.t_offset - 4).to_bytes(4, "big")
         s = self.broker.broker_key.sign(t + m,)
 
-        await self.websocket.send(s + t + m)
+        await self.enqueue(s + t + m)
 
     async def listen(self, inherit_entrypoint):
         n_tries = 0
@@ -551,14 +1149,14 @@ class Peer(Connection):
                 self.session = self.broker.sessions[session_id]
                 self.session.connections.add(self)
                 self.session.broker_connections[self] = self
+                for header in self.broker.route_announcement():
+                    await self.send(header)
 
                 n_tries = 0
                 while True:
                     message = await self.websocket.recv()
-                    self.tasks.add(asyncio.get_event_loop().create_task(self.broker.handle_message(self, message)))
-
-                    # await asyncio.gather(*(x for x in self.tasks if x.done() and not x.exception()), return_exceptions=True)
-                    self.tasks = set(x for x in self.tasks if not x.done())
+                    if self.broker.check_no_repeat(message, False):  # Frames can reach a broker over more than one link
+                        self.broker.dispatch_message(self, message)
 
             except IncompatibleBrokerException as e:
                 self.logger.error("Peer.listen", exc_info=True)
@@ -589,5 +1187,104 @@ class Peer(Connection):
         return wait_lock().__await__()
 
 
+class BrokerWorkers:
+    def __init__(self, n_workers=None, host="127.0.0.1", port=8776, peer_port=None, broker_key_file=None, **kwargs):
+        self.n_workers = n_workers or os.cpu_count()
+        self.host = host
+        self.port = port
+        self.peer_ports = [(peer_port or port + 1) + i for i in range(self.n_workers)]
+        self.key_dir = None
+        if not broker_key_file:  # Restarted workers keep their identity, so routes and tokens naming them stay valid
+            self.key_dir = tempfile.mkdtemp()
+            broker_key_file = os.path.join(self.key_dir, "broker.pem")
+        self.broker_key_file = broker_key_file
+        self.kwargs = kwargs
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = [None] * self.n_workers
+        self.logger = logging.getLogger(__name__)
+        self.supervisor = None
+
+    def start_worker(self, i, peers):
+        process = self.context.Process(
+            target=run_worker,
+            args=(
+                self.host,
+                self.port,
+                self.peer_ports[i],
+                [self.peer_ports[j] for j in peers],
+                f"{self.broker_key_file}.{i}",
+                dict(self.kwargs, snapshot_file=f"{self.kwargs['snapshot_file']}.{i}")
+                if self.kwargs.get("snapshot_file") else self.kwargs,
+            ),
+            daemon=True,
+        )
+        process.start()
+        self.processes[i] = process
+
+    def start(self):
+        for i in range(self.n_workers):
+            self.start_worker(i, range(i))  # Each link between two workers is shared by both
+        self.supervisor = asyncio.get_event_loop().create_task(self.supervise())
+        return self
+
+    async def supervise(self, interval=1):
+        while True:
+            await asyncio.sleep(interval)
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    self.logger.error("Broker worker %d exited with code %s, restarting", i, process.exitcode)
+                    self.start_worker(i, range(i))  # The later workers' peers reconnect by themselves
+
+    def close(self):
+        if self.supervisor:
+            self.supervisor.cancel()
+        for process in self.processes:
+            if process and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process:
+                process.join()
+        if self.key_dir:
+            shutil.rmtree(self.key_dir, ignore_errors=True)
+
+
+def run_worker(host, port, peer_port, peer_ports, broker_key_file, kwargs):
+    async def serve():
+        broker = Broker(broker_key_file, **kwargs)
+        await broker.serve(host, port, reuse_port=True)
+        await broker.serve("127.0.0.1", peer_port, transport="tcp")
+        for p in peer_ports:
+            await broker.add_broker(f"tcp://127.0.0.1:{p}")
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(serve())
+    loop.run_forever()
+
+
+def write_snapshot_file(path, state):
+    if os.path.exists(path + ".tmp"):
+        os.remove(path + ".tmp")  # The mode only applies to new files
+    with os.fdopen(os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(zlib.compress(bson.dumps(state)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)  # Readers see either the previous snapshot or the new one
+
+
+def append_journal(path, data):
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "a") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def rotate_journal(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            append_journal(path + ".old", f.read())
+        os.remove(path)
+
+
 class IncompatibleBrokerException(Exception):
     pass
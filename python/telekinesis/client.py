@@ -7,17 +7,23 @@ import zlib
 from collections import deque, OrderedDict
 from pkg_resources import get_distribution
 import hashlib
+import hmac
+import base64
 
-import websockets
 import ujson
 
 from .cryptography import PrivateKey, PublicKey, SharedKey, Token, InvalidSignature
+from .transport import connect
+
+FRAMING_VERSION = 2
+V2_SENTINEL = b"\xff\xff"  # In place of the 2 byte header length of v1 frames
 
 
 class Connection:
     def __init__(self, session, url="ws://localhost:8776"):
         self.RESEND_TIMEOUT = 2  # sec
         self.MAX_SEND_RETRIES = 3
+        self.MAX_REPLAY_BATCH = 2 ** 15  # bytes of headers per frame when restoring state on the broker
 
         self.session = session
         self.url = url
@@ -26,6 +32,8 @@ class Connection:
         self.t_offset = 0
         self.broker_id = None
         self.entrypoint = None
+        self.ticket = None
+        self.framing = 1
 
         self.is_connecting_lock = asyncio.Event()
         self.awaiting_ack = OrderedDict()
@@ -49,7 +57,7 @@ class Connection:
         if self.websocket:
             await self.websocket.close()
 
-        self.websocket = await websockets.connect(self.url)
+        self.websocket = await connect(self.url)
 
         challenge = await self.websocket.recv()
         t_broker = int.from_bytes(challenge[-4:], "big")
@@ -60,7 +68,12 @@ class Connection:
         pk = self.session.session_key.public_serial().encode()
 
         sent_challenge = os.urandom(32)
-        sent_metadata = {"version": get_distribution(__name__.split(".")[0]).version}
+        sent_metadata = {
+            "version": get_distribution(__name__.split(".")[0]).version, "resumable": True, "framing": FRAMING_VERSION
+        }
+        if self.ticket:
+            proof = hmac.new(self.ticket["secret"], challenge, "sha256").hexdigest()
+            sent_metadata["resume"] = {"ticket": self.ticket["id"], "proof": proof}
         await self.websocket.send(
             signature + pk + sent_challenge + ujson.dumps(sent_metadata, escape_forward_slashes=False).encode())
 
@@ -70,40 +83,75 @@ class Connection:
             raise Exception(m.decode())
 
         broker_signature, broker_id, metadata = m[:64], m[64:152].decode(), ujson.loads(m[152:].decode())
-        PublicKey(broker_id).verify(broker_signature, sent_challenge)
+        resumed = bool(metadata.get("resumed"))
+        if resumed:
+            ticket, self.ticket = self.ticket, None  # The next attempt does a full handshake if this one fails
+            proof = ticket and hmac.new(ticket["secret"], sent_challenge, "sha256").digest()
+            if not proof or ticket["broker_id"] != broker_id or not hmac.compare_digest(broker_signature[:32], proof):
+                raise Exception("Invalid session resumption proof")
+            self.ticket = ticket
+        else:
+            PublicKey(broker_id).verify(broker_signature, sent_challenge)
+
+        if metadata.get("ticket"):
+            encrypted = base64.b64decode(metadata["ticket"]["secret"])
+            shared_key = SharedKey(self.session.session_key, PublicKey(broker_id))
+            self.ticket = {
+                "id": metadata["ticket"]["id"],
+                "secret": shared_key.decrypt(encrypted[16:], encrypted[:16]),
+                "broker_id": broker_id,
+            }
+        elif not resumed:
+            self.ticket = None
 
         self.broker_id = broker_id
         self.entrypoint = Route(**metadata.get("entrypoint")) if metadata.get("entrypoint") else None
 
+        self.framing = min(metadata.get("framing", 1), FRAMING_VERSION)
+
+        if not resumed:  # A resumed session kept its tokens and channels on the broker
+            await self.replay()
+
+        self.is_connecting_lock.set()
+
+        return self
+
+    async def replay(self):
         headers = []
-        for token, prev_token in self.session.issued_tokens.values():
+        for token, prev_token in list(self.session.issued_tokens.values()):
             headers.append(("token", ("issue", token.encode(), prev_token and prev_token.encode())))
-        for channel in self.session.channels.values():
+        for channel in list(self.session.channels.values()):
             listen_dict = channel.route.to_dict()
             listen_dict["is_public"] = channel.is_public
             listen_dict.pop("tokens")
             headers.append(("listen", listen_dict))
-        await self.send(headers)
-
-        self.is_connecting_lock.set()
 
-        return self
+        # Tokens come first and parents before children, so every batch only depends on earlier ones
+        batch, size = [], 0
+        for header in headers:
+            n = len(ujson.dumps(header, escape_forward_slashes=False))
+            if batch and size + n > self.MAX_REPLAY_BATCH:
+                await self.send(batch)
+                batch, size = [], 0
+            batch.append(header)
+            size += n
+        await self.send(batch)
+
+    def encode(self, header, payload, message_id, retry):
+        h = ujson.dumps(header, escape_forward_slashes=False).encode()
+        r = (retry).to_bytes(1, "big") + (message_id or b"0" * 64)
+        p = hashlib.sha256(payload).digest()
+        m = frame_prefix(len(h), len(r + p + payload), self.framing) + h + r + p
+        t = int(time.time() - self.t_offset).to_bytes(4, "big")
+        s = self.session.session_key.sign(t + m)
+        return s, t + m + payload
 
     async def send(self, header, payload=b"", bundle_id=None, ack_message_id=None):
         self.logger.info(
             "%s sending: %s %s", self.session.session_key.public_serial()[:4], " ".join(h[0] for h in header), len(payload),
         )
 
-        def encode(header, payload, bundle_id, message_id, retry):
-            h = ujson.dumps(header, escape_forward_slashes=False).encode()
-            r = (retry).to_bytes(1, "big") + (message_id or b"0" * 64)
-            p = hashlib.sha256(payload).digest()
-            m = len(h).to_bytes(2, "big") + len(r + p + payload).to_bytes(3, "big") + h + r + p
-            t = int(time.time() - self.t_offset).to_bytes(4, "big")
-            s = self.session.session_key.sign(t + m)
-            return s, t + m + payload
-
-        s, mm = encode(header, payload, bundle_id, ack_message_id, 255 if ack_message_id else 0)
+        s, mm = self.encode(header, payload, ack_message_id, 255 if ack_message_id else 0)
         message_id = s
 
         expect_ack = "send" in set(a for a, _ in header) and not ack_message_id
@@ -138,7 +186,7 @@ class Connection:
                 return
 
             if retry < (self.MAX_SEND_RETRIES):
-                s, mm = encode(header, payload, bundle_id, message_id, retry+1)
+                s, mm = self.encode(header, payload, message_id, retry+1)
                 self.logger.info("%s retrying send %d", self.session.session_key.public_serial()[:4], retry)
 
         raise Exception("%s Max send retries reached" % self.session.session_key.public_serial()[:4])
@@ -198,9 +246,9 @@ class Connection:
 
         if self.session.check_no_repeat(signature, timestamp + self.t_offset):
 
-            len_h, len_p = [int.from_bytes(x, "big") for x in [message[68:70], message[70:73]]]
-            header = ujson.loads(message[73: 73 + len_h])
-            full_payload = message[73 + len_h: 73 + len_h + len_p]
+            offset, len_h, len_p = frame_lengths(message)
+            header = ujson.loads(message[offset: offset + len_h])
+            full_payload = message[offset + len_h: offset + len_h + len_p]
             self.logger.info(
                 "%s received: %s %s",
                 self.session.session_key.public_serial()[:4],
@@ -210,7 +258,7 @@ class Connection:
             for action, content in header:
                 if action == "send":
                     source, destination = Route(**content["source"]), Route(**content["destination"])
-                    PublicKey(source.session).verify(signature, message[64: 73 + len_h + 65 + 32])
+                    PublicKey(source.session).verify(signature, message[64: offset + len_h + 65 + 32])
                     if self.session.channels.get(destination.channel):
                         channel = self.session.channels.get(destination.channel)
                         if full_payload[0] == 255:
@@ -253,14 +301,74 @@ class Connection:
         return await_lock().__await__()
 
 
+class TokenRegistry:
+    def __init__(self):
+        self.tokens = {}
+        self.index = {}
+        self.children = {}
+
+    def add(self, signature, token, prev_token):
+        self.tokens[signature] = token, prev_token
+        self.index.setdefault((token.asset, token.receiver, token.token_type, token.max_depth), []).append(signature)
+        self.children.setdefault(token.asset, {})[signature] = None  # A dict keeps the issue order
+
+    def find(self, asset, receiver, token_type, max_depth):
+        for signature in self.index.get((asset, receiver, token_type, max_depth), []):
+            yield self.tokens[signature]
+
+    def remove(self, asset):
+        removed = []
+        stack = [asset]
+        while stack:
+            signature = stack.pop()
+            if signature in self.tokens:
+                token, _ = self.tokens.pop(signature)
+                removed.append(token)
+                key = (token.asset, token.receiver, token.token_type, token.max_depth)
+                self.index[key].remove(signature)
+                if not self.index[key]:
+                    self.index.pop(key)
+                siblings = self.children.get(token.asset)
+                if siblings is not None:
+                    siblings.pop(signature, None)
+                    if not siblings:
+                        self.children.pop(token.asset)
+            stack.extend(reversed(list(self.children.pop(signature, ()))))  # Children are revoked in issue order
+        return removed
+
+    def get(self, signature, default=None):
+        return self.tokens.get(signature, default)
+
+    def values(self):
+        return self.tokens.values()
+
+    def items(self):
+        return self.tokens.items()
+
+    def __getitem__(self, signature):
+        return self.tokens[signature]
+
+    def __contains__(self, signature):
+        return signature in self.tokens
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+
 class Session:
-    def __init__(self, session_key_file=None):
+    def __init__(self, session_key_file=None, token_ttl=None):
         self.session_key = PrivateKey(session_key_file)
+        self.token_ttl = token_ttl
+        self.next_token_gc = 0
         self.channels = {}
         self.connections = set()
         self.seen_messages = [set(), set(), 0]
-        self.issued_tokens = {}
+        self.issued_tokens = TokenRegistry()
         self.pending_tasks = set()
+        self.dispatcher = None
 
     def check_no_repeat(self, signature, timestamp):
         now = int(time.time())
@@ -286,14 +394,14 @@ class Session:
             prev_token = None
             asset = target
 
-        for token, prev_token_tmp in self.issued_tokens.values():
-            if (
-                token.asset == asset
-                and token.receiver == receiver
-                and token.token_type == token_type
-                and token.max_depth == max_depth
-                and all([x.broker_id in token.brokers for x in self.connections])
-            ):
+        now = self.broker_time()
+        if self.token_ttl and now > self.next_token_gc:
+            self.expire_tokens()
+
+        for token, prev_token_tmp in self.issued_tokens.find(asset, receiver, token_type, max_depth):
+            # Tokens are only handed out again while they have at least half of their lifetime left
+            fresh = not token.valid_until or token.valid_until - now > (self.token_ttl or 0) / 2
+            if fresh and all([x.broker_id in token.brokers for x in self.connections]):
                 prev_token = prev_token_tmp
                 break
         else:
@@ -304,21 +412,29 @@ class Session:
                 asset,
                 token_type,
                 max_depth,
+                valid_until=self.token_ttl and now + self.token_ttl,
             )
             signature = token.sign(self.session_key)
 
-            self.issued_tokens[signature] = token, prev_token
+            self.issued_tokens.add(signature, token, prev_token)
 
         return ("token", ("issue", token.encode(), prev_token and prev_token.encode()))
 
-    def revoke_tokens(self, asset):
-        children = [tid for tid, t in self.issued_tokens.items() if t[0].asset == asset]
-        headers = [h for hs in [self.revoke_tokens(tid) for tid in children] for h in hs]
+    def broker_time(self):
+        # Token expiry is stamped and checked in broker time, like message timestamps
+        offsets = [connection.t_offset for connection in self.connections]
+        return time.time() - (max(offsets) if offsets else 0)
 
-        tokens = self.issued_tokens.pop(asset, None)
-        if tokens:
-            return [("token", ("revoke", tokens[0].signature))] + headers
-        return headers
+    def expire_tokens(self):
+        now = self.broker_time()
+        self.next_token_gc = now + (self.token_ttl or 0) / 2
+        expired = [
+            signature for signature, (token, _) in self.issued_tokens.items() if token.valid_until and token.valid_until < now
+        ]
+        return [token for signature in expired for token in self.issued_tokens.remove(signature)]
+
+    def revoke_tokens(self, asset):
+        return [("token", ("revoke", token.signature)) for token in self.issued_tokens.remove(asset)]
 
     def extend_route(self, route, receiver, max_depth=None):
 
@@ -475,8 +591,12 @@ class Channel:
         return self
 
     async def execute(self, header=None, payload=b"", bundle_id=None):
-        await self.session.send([h for h in (self.header_buffer + [header]) if h], payload, bundle_id)
-        self.header_buffer = []
+        header_buffer, self.header_buffer = self.header_buffer, []  # Concurrent sends may share this channel
+        try:
+            await self.session.send([h for h in (header_buffer + [header]) if h], payload, bundle_id)
+        except Exception:
+            self.header_buffer = header_buffer + self.header_buffer
+            raise
 
         return self
 
@@ -506,6 +626,8 @@ class Channel:
                 token = Token.decode(token_string)
             except InvalidSignature:
                 return False
+            if token.valid_until and token.valid_until < self.session.broker_time():
+                return False
             if (token.asset == asset) and (token.issuer == last_receiver):
                 if token.issuer == self.session.session_key.public_serial():
                     if token.signature not in self.session.issued_tokens:
@@ -553,3 +675,17 @@ class Route:
 
     def __repr__(self):
         return f"Route {self.session[:4]} {self.channel[:4]}"
+
+
+def frame_prefix(len_h, len_p, framing=1):
+    if len_h < 2 ** 16 - 1 and len_p < 2 ** 24:
+        return len_h.to_bytes(2, "big") + len_p.to_bytes(3, "big")
+    if framing < 2:
+        raise Exception(f"Frame too large for framing version {framing}: header {len_h} B, payload {len_p} B")
+    return V2_SENTINEL + len_h.to_bytes(4, "big") + len_p.to_bytes(4, "big")
+
+
+def frame_lengths(message):
+    if message[68:70] == V2_SENTINEL:
+        return 78, int.from_bytes(message[70:74], "big"), int.from_bytes(message[74:78], "big")
+    return 73, int.from_bytes(message[68:70], "big"), int.from_bytes(message[70:73], "big")
@@ -17,7 +17,7 @@ async def authenticate(url, session_key_file=None, print_callback=print, **kwarg
 async def PublicUser(url, session_key_file=None):
     s = Session(session_key_file)
 
-    if re.sub(r'(?![\w\d]+:\/\/[\w\d.]+):[\d]+', '', url) == url:
+    if not url.startswith("unix://") and re.sub(r'(?![\w\d]+:\/\/[\w\d.]+):[\d]+', '', url) == url:
         i = len(re.findall(r'[\w\d]+:\/\/[\w\d.]+', url)[0])
         url = url[:i] + ':8776' + url[i:]
 
@@ -0,0 +1,103 @@
+import asyncio
+import bisect
+import logging
+
+
+class Metrics:
+    def __init__(self, prefix="telekinesis_broker_", buckets=None):
+        self.prefix = prefix
+        self.buckets = buckets or [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.servers = {}
+        self.logger = logging.getLogger(__name__)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        histogram = self.histograms[key]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def prune(self, label, keep):
+        # Drops series whose value for label is no longer in keep, e.g. sessions that were collected
+        for table in [self.counters, self.histograms]:
+            for key in [k for k in table if label in dict(k[1]) and dict(k[1])[label] not in keep]:
+                table.pop(key)
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def to_dict(self):
+        out = {}
+        for (name, labels), value in self.counters.items():
+            out.setdefault(name, []).append((dict(labels), value))
+        for (name, labels), (counts, total, count) in self.histograms.items():
+            out.setdefault(name, []).append(
+                (dict(labels), {"buckets": dict(zip(self.buckets, counts)), "sum": total, "count": count})
+            )
+        for name, callback in self.gauges.items():
+            out[name] = [(dict(labels), value) for labels, value in callback()]
+        return out
+
+    def to_prometheus(self):
+        lines = []
+        for kind, metrics in [("counter", self.counters), ("histogram", self.histograms)]:
+            for name in sorted(set(name for name, _ in metrics)):
+                lines.append("# TYPE %s%s %s" % (self.prefix, name, kind))
+                for (metric_name, labels), value in metrics.items():
+                    if metric_name != name:
+                        continue
+                    if kind == "counter":
+                        lines.append("%s%s%s %s" % (self.prefix, name, format_labels(labels), value))
+                        continue
+                    counts, total, count = value
+                    cumulative = 0
+                    for le, n in zip(self.buckets + ["+Inf"], counts):
+                        cumulative += n
+                        bucket_labels = format_labels(labels + (("le", le),))
+                        lines.append("%s%s_bucket%s %s" % (self.prefix, name, bucket_labels, cumulative))
+                    lines.append("%s%s_sum%s %s" % (self.prefix, name, format_labels(labels), total))
+                    lines.append("%s%s_count%s %s" % (self.prefix, name, format_labels(labels), count))
+        for name, callback in sorted(self.gauges.items()):
+            lines.append("# TYPE %s%s gauge" % (self.prefix, name))
+            for labels, value in callback():
+                lines.append("%s%s%s %s" % (self.prefix, name, format_labels(tuple(sorted(labels.items()))), value))
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(self, reader, writer):
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            body = self.to_prometheus().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n"
+                % len(body) + body
+            )
+            await writer.drain()
+        except Exception:
+            self.logger.info("Metrics request failed", exc_info=True)
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=9776):
+        self.servers[(host, port)] = await asyncio.start_server(self.handle_request, host, port)
+        return self
+
+    def close(self):
+        for server in self.servers.values():
+            server.close()
+        self.servers.clear()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
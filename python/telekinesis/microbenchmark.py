@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import inspect
+import sys
+import time
+
+from .benchmark import report
+from .broker import Broker
+from .client import Connection, Session, Channel
+from .cryptography import Token
+from .telekinesis import Telekinesis, State
+
+
+class Sample:
+    def __init__(self):
+        self.name = "sample"
+        self.values = list(range(10))
+
+    def get(self, key):
+        return self.values[key]
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def append(self, value, times=1, *args, **kwargs):
+        self.values.extend([value] * times)
+
+    async def fetch(self, key, default=None):
+        return self.values[key] if key < len(self.values) else default
+
+
+def sample_payload():
+    return {
+        "ints": list(range(100)),
+        "strs": ["telekinesis"] * 100,
+        "nested": [{"a": i, "b": [i, str(i)], "c": (i, None)} for i in range(50)],
+        "bytes": b"\x00" * 1024,
+    }
+
+
+async def measure(func, number, repeat):
+    is_async = inspect.iscoroutinefunction(func)
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            if is_async:
+                await func()
+            else:
+                func()
+        timings.append((time.perf_counter() - t) / number)
+    timings.sort()
+    return {
+        "min": timings[0],
+        "median": timings[len(timings) // 2],
+        "max": timings[-1],
+        "ops_per_sec": 1 / timings[0] if timings[0] else None,
+    }
+
+
+async def run_microbenchmarks(number=1000, repeat=5, only=None, port=8950):
+    broker = await Broker().serve(port=port)
+    connections = []
+    try:
+        connections.append(await Connection(Session(), f"ws://127.0.0.1:{port}"))
+        connections.append(await Connection(Session(), f"ws://127.0.0.1:{port}"))
+        connection_0, connection_1 = connections
+        session_0, session_1 = connection_0.session, connection_1.session
+
+        sample = Sample()
+        tk = Telekinesis(sample, session_0)
+        route = tk._delegate(session_1.session_key.public_serial())
+        remote = await asyncio.wait_for(Telekinesis(route, session_1), 15)
+        payload = sample_payload()
+        encoded = tk._encode(payload)
+        state = State.from_object(sample)
+        local = Telekinesis._from_state(state.clone(), tk._delegate(session_0.session_key.public_serial()), session_0)
+
+        offline_session = Session()  # Without connections, Channel.send stops after chunking, compressing and encrypting
+        offline_channel = Channel(offline_session)
+        destination = Channel(Session()).route
+        enc_token = session_0.issue_token("channel", session_1.session_key.public_serial())[1][1]
+        header = [("send", {"source": route.to_dict(), "destination": route.to_dict()})]
+        frame_payload = b"\x00" * 4096
+
+        async def channel_send():
+            await offline_channel.send(destination, payload)
+
+        async def round_trip():
+            await remote.get(1)
+
+        async def local_call():
+            await local.get(1)
+
+        benchmarks = {
+            "encode": lambda: tk._encode(payload),
+            "decode": lambda: tk._decode(encoded),
+            "state_from_object": lambda: State.from_object(sample),
+            "from_state": lambda: Telekinesis._from_state(state.clone(), route, session_1, parent=remote),  # Not a root
+            "channel_send": channel_send,
+            "connection_encode": lambda: connection_0.encode(header, frame_payload, None, 0),
+            "token_decode": lambda: Token.decode(enc_token),
+            "token_decode_unverified": lambda: Token.decode(enc_token, False),
+            "rpc_round_trip": round_trip,
+            "local_call": local_call,
+        }
+
+        results = {}
+        round_trip_number = max(1, number // 10)
+        for name, func in benchmarks.items():
+            if not only or name in only:
+                results[name] = await measure(func, number if name != "rpc_round_trip" else round_trip_number, repeat)
+    finally:
+        # Without connections, the close messages sent when the remaining objects are collected are dropped
+        for connection in connections:
+            connection.listener.cancel()
+            connection.session.connections.discard(connection)
+            if connection.websocket:
+                await connection.websocket.close()
+        await broker.close()
+
+    return {
+        "benchmark": "client",
+        "config": {"number": number, "round_trip_number": round_trip_number, "repeat": repeat},
+        "results": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Client hot path microbenchmarks")
+    parser.add_argument("--number", type=int, default=1000, help="calls per timing")
+    parser.add_argument("--repeat", type=int, default=5, help="timings per benchmark, the fastest is reported as ops_per_sec")
+    parser.add_argument("--only", default=None, help="comma separated benchmark names")
+    parser.add_argument("--port", type=int, default=8950)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    args = parser.parse_args(argv)
+
+    result = asyncio.get_event_loop().run_until_complete(
+        run_microbenchmarks(args.number, args.repeat, args.only and args.only.split(","), args.port)
+    )
+    sys.stdout.write(report(result, args.output, args.baseline) + "\n")
+
+
+if __name__ == "__main__":
+    main()
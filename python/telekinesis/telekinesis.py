@@ -5,6 +5,11 @@ import asyncio
 import inspect
 import traceback
 import logging
+import itertools
+import copy
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import partialmethod
 
 import re
@@ -37,10 +42,10 @@ class State:
         return State(**self.to_dict())
 
     @staticmethod
-    def from_object(target):
+    def from_object(target, max_repr_len=None):
         logger = logging.getLogger(__name__)
 
-        attributes, methods, repr_ = [], {}, ""
+        attributes, methods = [], {}
 
         for attribute_name in dir(target):
             if attribute_name[0] != "_" or attribute_name in [
@@ -49,6 +54,7 @@ class State:
                 "__setitem__",
                 "__add__",
                 "__mul__",
+                "__next_batch__",
             ]:
                 try:
                     if isinstance(target, type):
@@ -80,14 +86,142 @@ class State:
                     logger.error("Could not obtain handle for %s.%s: %s", target, attribute_name, e)
 
         if isinstance(target, type):
-            repr_ = str(type(target))
             methods["__call__"] = (str(inspect.signature(target)), target.__init__.__doc__)
             doc = target.__doc__
         else:
             doc = None
-            repr_ = target.__repr__()
 
-        return State(attributes, methods, repr_, doc, None, time.time())
+        return State(attributes, methods, State.repr_from_object(target, max_repr_len), doc, None, time.time())
+
+    @staticmethod
+    def repr_from_object(target, max_repr_len=None):
+        if max_repr_len == 0:
+            return ""
+        repr_ = str(type(target)) if isinstance(target, type) else target.__repr__()
+
+        return repr_ if max_repr_len is None else repr_[:max_repr_len]
+
+
+class Cache:
+    def __init__(self, ttl=None, max_size=256, methods=None, copy_values=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.methods = set(methods or [])
+        self.copy_values = copy_values  # Callers get their own copy of mutable values
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, route, pipeline):
+        if not pipeline:
+            return None
+        for i, (action, arg) in enumerate(pipeline):
+            if action == "call" and not (i and pipeline[i - 1][0] == "get" and pipeline[i - 1][1] in self.methods):
+                return None
+        try:
+            return (route.session, route.channel, freeze(pipeline))
+        except TypeError:
+            return None
+
+    def get(self, key, version):
+        if key in self.entries:
+            value, entry_version, expires = self.entries[key]
+            if entry_version == version and (expires is None or expires > time.time()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, copy.deepcopy(value) if self.copy_values else value
+            self.entries.pop(key)
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value, version):
+        if self.copy_values:
+            try:
+                value = copy.deepcopy(value)
+            except Exception:  # Values that can't be copied aren't cached
+                return
+        self.entries[key] = (value, version, self.ttl and time.time() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+            "size": len(self.entries),
+        }
+
+
+class Executor:
+    shared = {}
+
+    def __init__(self, mode="thread", max_workers=None):
+        self.mode = mode
+        self.pool = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}[mode](max_workers)
+        self.stats = {"calls": 0, "pending": 0, "max_pending": 0, "queue_time": 0.0, "run_time": 0.0}
+
+    @staticmethod
+    def get(executor):
+        if executor == "inline":
+            return None
+        if executor is None or isinstance(executor, Executor):
+            return executor
+        if executor not in Executor.shared:
+            Executor.shared[executor] = Executor(executor)
+        return Executor.shared[executor]
+
+    def accepts(self, func):
+        if asyncio.iscoroutinefunction(func):
+            return False
+        # Process workers call a pickled copy, so methods would change a copy of their object and run inline instead
+        return self.mode != "process" or (
+            inspect.isfunction(func) and "." not in func.__qualname__ and func.__name__ != "<lambda>"
+        )
+
+    async def run(self, func, *args, **kwargs):
+        submitted = time.time()
+        self.stats["calls"] += 1
+        self.stats["pending"] += 1
+        self.stats["max_pending"] = max(self.stats["max_pending"], self.stats["pending"])
+        try:
+            started, ret = await asyncio.get_event_loop().run_in_executor(self.pool, timed_call, func, args, kwargs)
+        finally:
+            self.stats["pending"] -= 1
+
+        self.stats["queue_time"] += started - submitted
+        self.stats["run_time"] += time.time() - started
+        return ret
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait)
+
+
+class Stream:
+    def __init__(self, iterator, max_batch_size=1000):
+        self.iterator = iterator
+        self.max_batch_size = max_batch_size
+
+    async def __next_batch__(self, n=None):
+        n = min(n or self.max_batch_size, self.max_batch_size)
+        items = []
+        try:
+            while len(items) < n:
+                if inspect.isasyncgen(self.iterator):
+                    items.append(await self.iterator.__anext__())
+                else:
+                    items.append(next(self.iterator))
+        except (StopIteration, StopAsyncIteration):
+            return items, True
+
+        return items, False
+
+    def __repr__(self):
+        return "Stream %s" % self.iterator
 
 
 class Listener:
@@ -127,9 +261,66 @@ class Listener:
             await self.channel.close()
 
 
+class Dispatcher:
+    def __init__(self, session):
+        self.session = session
+        self.listener = None
+        self.listen_task = None
+        self.requests = {}
+        self.request_ids = itertools.count()
+        self.multiplexed_sessions = set()
+        self.clients = weakref.WeakSet()  # Root objects that use the shared channel
+
+    @staticmethod
+    def get(session):
+        if not session.dispatcher:
+            session.dispatcher = Dispatcher(session)
+        return session.dispatcher
+
+    def get_listener(self, client):
+        self.clients.add(client)
+        if not self.listener:
+            self.listener = Listener(Channel(self.session))
+            self.listen_task = asyncio.get_event_loop().create_task(self.listen())
+        return self.listener
+
+    async def listen(self):
+        while True:
+            try:
+                await self.listener.channel.listen()
+                while True:
+                    source, response = await self.listener.channel.recv()
+                    session_id, future = self.requests.get(response.get("request_id"), (None, None))
+                    if future and source.session == session_id and not future.done():
+                        future.set_result(response)
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                logging.getLogger(__name__).error("Dispatcher error", exc_info=True)
+
+    async def request(self, destination, payload):
+        request_id = next(self.request_ids)
+        future = asyncio.get_event_loop().create_future()
+        self.requests[request_id] = (destination.session, future)
+        payload["request_id"] = request_id
+        try:
+            await self.listener.channel.send(destination, payload)
+            return await future
+        finally:
+            self.requests.pop(request_id, None)
+
+    async def release(self, client):
+        self.clients.discard(client)
+        if not self.clients and self.listener:
+            listener, self.listener = self.listener, None
+            self.listen_task.cancel()
+            await listener.channel.close()  # Also revokes the tokens issued on the shared channel
+
+
 class Telekinesis:
     def __init__(
         self, target, session, mask=None, expose_tb=True, max_delegation_depth=None, compile_signatures=True, parent=None,
+        max_repr_len=None, lazy_repr=False, cache=None, executor=None, isolate=False,
     ):
 
         self._logger = logging.getLogger(__name__)
@@ -140,11 +331,17 @@ class Telekinesis:
         self._max_delegation_depth = max_delegation_depth
         self._compile_signatures = compile_signatures
         self._parent = parent
+        self._max_repr_len = max_repr_len
+        self._lazy_repr = lazy_repr
+        self._cache = cache
+        self._executor = Executor.get(executor)
+        self._isolate = isolate
+        self._memo_caches = {}
         self._listeners = {}
         if isinstance(target, Route):
             self._state = State()
         else:
-            self._update_state(State.from_object(target))
+            self._update_state(State.from_object(target, 0 if lazy_repr else max_repr_len))
 
     def __getattribute__(self, attr):
         if attr[0] == "_":  # and (attr != '__call__'):
@@ -164,10 +361,47 @@ class Telekinesis:
             self,
         )
 
+    def _get_root(self):
+        if self._parent:
+            return self._parent._get_root()
+        return self
+
     def _get_root_state(self):
+        return self._get_root()._state
+
+    def _get_cache(self):
+        return self._get_root()._cache
+
+    def _invalidate_cache(self, *methods):
+        for func, cache in self._get_root()._memo_caches.items():
+            if not methods or func.__name__ in methods or func.__qualname__ in methods:
+                cache.clear()
+
+    def _cache_stats(self):
+        return {func.__qualname__: cache.stats() for func, cache in self._get_root()._memo_caches.items()}
+
+    def _memo_cache(self, target):
+        memo = getattr(target, "_tk_memoize", None)
+        if not memo:
+            return None
+        func = getattr(target, "__func__", target)
+        memo_caches = self._get_root()._memo_caches
+        if func not in memo_caches:
+            memo_caches[func] = Cache(*memo, copy_values=True)
+            func._tk_memo_caches.add(memo_caches[func])
+        return memo_caches[func]
+
+    def _refresh_state(self):
         if self._parent:
-            return self._parent._get_root_state()
-        return self._state
+            return self._get_root()._refresh_state()
+
+        self._update_state(State.from_object(self._target, 0 if self._lazy_repr else self._max_repr_len))
+        self._state.last_change = time.time()
+
+    def _state_update(self, payload):
+        if self._lazy_repr or (payload.get("timestamp") and payload.get("timestamp") == self._state.last_change):
+            return {"timestamp": self._state.last_change}
+        return {"repr": self._state.repr, "timestamp": self._state.last_change}
 
     def _update_state(self, state):
         for d in dir(self):
@@ -199,6 +433,8 @@ class Telekinesis:
         if isinstance(self._target, Route):
             route = self._target.clone()
             max_delegation_depth = None
+            if route.session == receiver_id:  # The owner checks the chain we already hold, no need to extend it
+                return route
 
         else:
             route = self._add_listener(Channel(self._session))
@@ -209,34 +445,42 @@ class Telekinesis:
                 parent_channel = listener.channel
 
         token_header = self._session.extend_route(route, receiver_id, max_delegation_depth)
-        parent_channel.header_buffer.append(token_header)
+        if token_header not in parent_channel.header_buffer:  # Reissued tokens would pile up on channels that rarely send
+            parent_channel.header_buffer.append(token_header)
 
         return route
 
     async def _handle_request(self, listener, reply, payload):
+        response = await self._respond(listener, reply, payload)
+        if response is not None:
+            await listener.channel.send(reply, response)
+
+    async def _respond(self, listener, reply, payload, serialize=True):
+        request_id = {"request_id": payload["request_id"]} if "request_id" in payload else {}
         try:
             if "close" in payload:
                 await listener.close()
             elif "ping" in payload:
-                await listener.channel.send(reply, {"repr": self._state.repr, "timestamp": self._state.last_change})
+                repr_ = State.repr_from_object(self._target, self._max_repr_len) if self._lazy_repr else self._state.repr
+                return {"repr": repr_, "timestamp": self._state.last_change, **request_id}
             elif "pipeline" in payload:
-                pipeline = self._decode(payload.get("pipeline"), reply.session)
+                pipeline = payload.get("pipeline")
+                if serialize:
+                    pipeline = self._decode(pipeline, reply.session)
                 self._logger.info("%s called %s", reply.session[:4], len(pipeline))
                 ret = await self._execute(listener, reply, pipeline)
 
-                await listener.channel.send(reply, {
-                    "return": self._encode(ret, reply.session, listener),
-                    "repr": self._state.repr,
-                    "timestamp": self._state.last_change})
+                return {
+                    "return": self._encode(ret, reply.session, listener) if serialize else ret,
+                    **self._state_update(payload),
+                    **request_id,
+                }
 
         except Exception:
             self._logger.error("Telekinesis request error with payload %s", payload, exc_info=True)
 
             self._state.pipeline.clear()
-            try:
-                await listener.channel.send(reply, {"error": traceback.format_exc() if self._expose_tb else ""})
-            finally:
-                pass
+            return {"error": traceback.format_exc() if self._expose_tb else "", **request_id}
 
     def _call(self, *args, **kwargs):
         state = self._state.clone()
@@ -261,70 +505,159 @@ class Telekinesis:
         self._state.pipeline.clear()
 
         if isinstance(self._target, Route):
-            async with Channel(self._session) as new_channel:
-                return await self._send_request(
-                    new_channel,
-                    pipeline=self._encode(pipeline, self._target.session, Listener(new_channel))
-                )
-
-        async def exc(x):
-            if isinstance(x, Telekinesis) and x._state.pipeline:
-                return await x._execute(listener, reply)
-            return x
-
+            cache = self._get_cache()
+            key = cache and cache.key(self._target, pipeline)
+            if key is None:
+                return await self._send_request(pipeline)
+
+            hit, ret = cache.get(key, self._get_root_state().last_change)
+            if not hit:
+                ret = await self._send_request(pipeline)
+                cache.set(key, ret, self._get_root_state().last_change)
+            return ret
+
+        executor = self._get_root()._executor
         target = self._target
-        for action, arg in pipeline:
+        mutated = False
+        for i, (action, arg) in enumerate(pipeline):
             if action == "get":
                 self._logger.info("%s %s %s", action, arg, target)
-                if (arg[0] == "_" and arg not in ["__getitem__", "__setitem__", "__add__", "__mul__"]) or arg in (
-                    self._mask or []
-                ):
+                if (
+                    arg[0] == "_" and arg not in ["__getitem__", "__setitem__", "__add__", "__mul__", "__next_batch__"]
+                ) or arg in (self._mask or []):
                     raise Exception("Unauthorized!")
                 target = target.__getattribute__(arg)
             if action == "call":
                 self._logger.info("%s %s", action, target)
-                ar, kw = arg
-                args, kwargs = [await exc(x) for x in ar], {x: await exc(kw[x]) for x in kw}
+                args, kwargs = await self._resolve(arg, listener, reply)
 
                 if "_tk_inject_first_arg" in dir(target) and target._tk_inject_first_arg:
-                    target = target(reply, *args, **kwargs)
+                    args = [reply, *args]
+
+                memo_cache = self._memo_cache(target)
+                key = memo_cache and memo_key(pipeline[:i], args, kwargs)
+                hit, ret = memo_cache.get(key, None) if key else (False, None)
+                if hit:
+                    target = ret
+                    continue
+                mutated = mutated or not memo_cache
+
+                if executor and executor.accepts(target):
+                    target = await executor.run(target, *args, **kwargs)
                 else:
                     target = target(*args, **kwargs)
-                if asyncio.iscoroutine(target):
+                if asyncio.iscoroutine(target) and not inspect.isgenerator(target):
                     target = await target
+                if key:
+                    memo_cache.set(key, target, None)
 
-        self._update_state(State.from_object(self._target))
-        self._state.last_change = time.time()
+        if mutated:  # Only calls to functions that aren't pure can change the state of the target
+            self._refresh_state()
         return target
 
-    async def _send_request(self, channel, **kwargs):
-        response = {}
-        await channel.send(self._target, kwargs)
+    async def _resolve(self, arg, listener=None, reply=None):
+        promises = {}
+
+        def collect(x, seen):
+            if isinstance(x, Telekinesis):
+                if x._state.pipeline:
+                    promises[id(x)] = x
+            elif type(x) in (list, tuple, set, dict) and id(x) not in seen:
+                seen.add(id(x))
+                for v in (x.values() if type(x) is dict else x):
+                    collect(v, seen)
+
+        def substitute(x, memo):
+            if isinstance(x, Telekinesis):
+                return results.get(id(x), x)
+            if type(x) not in (list, tuple, set, dict):
+                return x
+            if id(x) not in memo:
+                memo[id(x)] = x
+                if type(x) is list:
+                    x[:] = [substitute(v, memo) for v in x]
+                elif type(x) is dict:
+                    x.update({k: substitute(v, memo) for k, v in x.items()})
+                else:
+                    memo[id(x)] = type(x)(substitute(v, memo) for v in x)
+            return memo[id(x)]
+
+        collect(arg, set())
+        if not promises:
+            return arg
+
+        # Promises shared between arguments resolve once, independent ones resolve concurrently
+        results = dict(zip(promises, await asyncio.gather(*(x._execute(listener, reply) for x in promises.values()))))
+        return substitute(arg, {})
+
+    async def _send_request(self, pipeline=None, **kwargs):
+        dispatcher = Dispatcher.get(self._session)
+
+        kwargs["timestamp"] = self._get_root_state().last_change
+        isolate = self._get_root()._isolate
+        channel = self._session.channels.get(self._target.channel)
+        local = (
+            self._target.session == self._session.session_key.public_serial() and channel is not None
+            and channel.telekinesis is not None and channel.route in channel.telekinesis._listeners
+        )
+
+        if local:  # Same session, skip the crypto and the broker
+            if not channel.validate_token_chain(self._session.session_key.public_serial(), self._target.tokens):
+                raise Exception("Unauthorized!")
+            listener = dispatcher.get_listener(self._get_root())
+            if pipeline is not None:
+                kwargs["pipeline"] = self._encode(pipeline, self._target.session, listener) if isolate else pipeline
+            response = await channel.telekinesis._respond(
+                channel.telekinesis._listeners[channel.route], listener.channel.route, kwargs, isolate
+            )
+        elif self._target.session in dispatcher.multiplexed_sessions:
+            listener = dispatcher.get_listener(self._get_root())
+            if pipeline is not None:
+                kwargs["pipeline"] = self._encode(pipeline, self._target.session, listener)
+            response = await dispatcher.request(self._target, kwargs)
+        else:  # Peers that don't echo request ids get a channel per request
+            async with Channel(self._session) as new_channel:
+                if pipeline is not None:
+                    kwargs["pipeline"] = self._encode(pipeline, self._target.session, Listener(new_channel))
+                kwargs["request_id"] = next(dispatcher.request_ids)
+                await new_channel.send(self._target, kwargs)
+
+                _, response = await new_channel.recv()
 
-        _, response = await channel.recv()
+            if response.get("request_id") == kwargs["request_id"]:
+                dispatcher.multiplexed_sessions.add(self._target.session)
 
         state = self._get_root_state()
         if "repr" in response and ((response.get("timestamp") or 1e99) >= (state.last_change or 0)):
             state.last_change = response.get("timestamp") or time.time()
             state.repr = response["repr"]
-
-        if "repr" in response:
-            state = self._get_root_state()
+        elif (response.get("timestamp") or 0) > (state.last_change or 0):  # Only the version was sent
+            state.last_change = response["timestamp"]
 
         if "error" in response:
             raise Exception(response["error"])
 
         if "return" in response:
+            if local and not isolate:
+                return response["return"]
             return self._decode(response["return"], self._target.session)
 
         if "repr" not in response:
             raise Exception("Telekinesis communication error: received unrecognized message schema %s" % response)
 
+    async def _fetch_repr(self):
+        if isinstance(self._target, Route):
+            await self._send_request(ping=True)
+            return self._get_root_state().repr
+        return State.repr_from_object(self._target, self._max_repr_len)
+
     async def _close(self):
         try:
             if isinstance(self._target, Route):
                 async with Channel(self._session) as new_channel:
                     await new_channel.send(self._target, {"close": True})
+                if self._session.dispatcher:
+                    await self._session.dispatcher.release(self)
             else:
                 for listener in self._listeners:
                     await listener.close(True)
@@ -334,6 +667,36 @@ class Telekinesis:
     def __await__(self):
         return self._execute().__await__()
 
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self, batch_size=100):
+        stream = self
+        if self._state.pipeline or "__next_batch__" not in self._state.methods:
+            stream = await self._execute()
+        if not isinstance(stream, Telekinesis):  # Same session calls return generators as they are
+            if hasattr(stream, "__aiter__"):
+                async for item in stream:
+                    yield item
+            else:
+                for item in stream:
+                    yield item
+            return
+
+        batch = [("get", "__next_batch__"), ("call", ((batch_size,), {}))]
+        pending = asyncio.ensure_future(stream._execute(pipeline=batch))
+        try:
+            while True:
+                items, done = await pending
+                if not done:  # Keep the next batch in flight while this one is consumed
+                    pending = asyncio.ensure_future(stream._execute(pipeline=batch))
+                for item in items:
+                    yield item
+                if done:
+                    return
+        finally:
+            pending.cancel()
+
     def __repr__(self):
         return "\033[92m\u2248\033[0m " + str(self._state.repr)
 
@@ -367,9 +730,14 @@ class Telekinesis:
             if isinstance(arg, Telekinesis):
                 obj = arg
             else:
+                if inspect.isgenerator(arg) or inspect.isasyncgen(arg):
+                    arg = Stream(arg)
                 obj = Telekinesis(
                     arg, self._session, self._mask, self._expose_tb, self._max_delegation_depth, self._compile_signatures,
+                    max_repr_len=self._max_repr_len, lazy_repr=self._lazy_repr, executor=self._executor,
                 )
+                if arg is self._target:  # Memoized results belong to the target, not to the wrapper
+                    obj._memo_caches = self._get_root()._memo_caches
 
             route = obj._delegate(receiver_id, listener.channel)
             tup = (
@@ -421,18 +789,20 @@ class Telekinesis:
             if route.session == self._session.session_key.public_serial() and route.channel in self._session.channels:
                 channel = self._session.channels.get(route.channel)
                 if channel.validate_token_chain(caller_id, route.tokens):
-                    if state.pipeline:
-                        return Telekinesis._from_state(
+                    if state.pipeline:  # Evaluated here when the call that takes it runs, with its owner's mask
+                        owner = channel.telekinesis
+                        out = Telekinesis._from_state(
                             state,
-                            channel.telekinesis._target,
+                            owner._target,
                             self._session,
-                            self._mask,
-                            self._expose_tb,
-                            self._max_delegation_depth,
-                            self._compile_signatures,
-                            channel.telekinesis,
+                            owner._mask,
+                            owner._expose_tb,
+                            owner._max_delegation_depth,
+                            owner._compile_signatures,
+                            owner,
                         )
-                    out = channel.telekinesis._target
+                    else:
+                        out = channel.telekinesis._target
                 else:
                     raise Exception(f"Unauthorized! {caller_id} {route.tokens}")
             else:
@@ -444,6 +814,7 @@ class Telekinesis:
                     self._expose_tb,
                     self._max_delegation_depth,
                     self._compile_signatures,
+                    cache=self._get_cache(),
                 )
 
         output_stack[root] = out
@@ -452,6 +823,7 @@ class Telekinesis:
     @staticmethod
     def _from_state(
         state, target, session, mask=None, expose_tb=True, max_delegation_depth=None, compile_signatures=True, parent=None,
+        cache=None,
     ):
         def callable_subclass(signature, method_name, docstring):
             class Telekinesis_(Telekinesis):
@@ -468,7 +840,10 @@ class Telekinesis:
 
         method_name = state.pipeline[-1][1] if state.pipeline and state.pipeline[-1][0] == "get" else "__call__"
 
-        reset = "call" in [x[0] for x in state.pipeline[:-1]]
+        # Past a call, or on an attribute of a method (like a memoized method's invalidate), the target's state is unknown
+        reset = "call" in [x[0] for x in state.pipeline[:-1]] or (
+            len(state.pipeline) > 1 and state.pipeline[-2][0] == "get" and state.pipeline[-2][1] in state.methods
+        )
         if method_name in state.methods or reset:
             signature, docstring = (not reset and state.methods.get(method_name)) or (None, None)
             signature = signature or "(*args, **kwargs)"
@@ -533,13 +908,36 @@ class Telekinesis:
             if "__setitem__" in state.methods:
                 Telekinesis_.__setitem__ = setitem
 
-        out = Telekinesis_(target, session, mask, expose_tb, max_delegation_depth, compile_signatures, parent)
+        out = Telekinesis_(target, session, mask, expose_tb, max_delegation_depth, compile_signatures, parent, cache=cache)
         out._update_state(state)
         out.__doc__ = state.doc if method_name == "__call__" else docstring
 
         return out
 
 
+def timed_call(func, args, kwargs):
+    return time.time(), func(*args, **kwargs)
+
+
+def freeze(arg):
+    if type(arg) in (int, float, str, bytes, bool, type(None)):
+        return (type(arg).__name__, arg)
+    if type(arg) in (list, tuple, set, frozenset):
+        return (type(arg).__name__, (frozenset if type(arg) in (set, frozenset) else tuple)(freeze(x) for x in arg))
+    if type(arg) in (range, slice):
+        return (type(arg).__name__, (arg.start, arg.stop, arg.step))
+    if isinstance(arg, dict):
+        return ("dict", frozenset((freeze(k), freeze(v)) for k, v in arg.items()))
+    raise TypeError("Unhashable argument %s" % type(arg).__name__)
+
+
+def memo_key(pipeline, args, kwargs):
+    try:
+        return freeze((pipeline, args, kwargs))
+    except TypeError:  # Calls with callbacks or custom objects can't be memoized
+        return None
+
+
 def check_signature(signature):
     return not ("\n" in signature or (signature != re.sub(r"(?:[^A-Za-z0-9_])lambda(?=[\)\s\:])", "", signature)))
 
@@ -547,3 +945,17 @@ def check_signature(signature):
 def inject_first_arg(func):
     func._tk_inject_first_arg = True
     return func
+
+
+def memoize(func=None, ttl=None, max_size=256):
+    if func is None:
+        return lambda func: memoize(func, ttl, max_size)
+    func._tk_memoize = (ttl, max_size)
+    func._tk_memo_caches = weakref.WeakSet()
+
+    def invalidate():
+        for cache in list(func._tk_memo_caches):
+            cache.clear()
+
+    func.invalidate = invalidate  # Public, so remote callers can reach it as obj.method.invalidate()
+    return func
@@ -0,0 +1,95 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import weakref
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "timers")
+
+    def __init__(self, deadline, callback, args, timers):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.timers = timers  # Set while the timer is in the heap
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            if self.timers is not None:
+                self.timers.cancelled += 1
+
+
+class Timers:
+    instances = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.heap = []
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.handle = None
+        self.handle_deadline = None
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def get(loop=None):
+        loop = loop or asyncio.get_event_loop()
+        if loop not in Timers.instances:
+            Timers.instances[loop] = Timers(loop)
+        return Timers.instances[loop]
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.loop.time() + delay, callback, args, self)
+        heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+        if self.handle_deadline is None or timer.deadline < self.handle_deadline:
+            self.schedule()
+        return timer
+
+    def schedule(self):
+        if self.handle:
+            self.handle.cancel()
+        self.handle, self.handle_deadline = None, None
+        while self.heap and self.heap[0][2].cancelled:
+            self.pop()
+        if self.heap:
+            self.handle_deadline = self.heap[0][0]
+            self.handle = self.loop.call_at(self.handle_deadline, self.run)
+
+    def run(self):
+        self.handle, self.handle_deadline = None, None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            timer = self.pop()
+            if not timer.cancelled:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    self.logger.error("Timer callback failed", exc_info=True)
+
+        # Cancelled timers stay in the heap until they are due, unless they make up most of it
+        if len(self.heap) > 64 and self.cancelled > len(self.heap) // 2:
+            for _, _, timer in self.heap:
+                if timer.cancelled:
+                    timer.timers = None
+            self.heap = [x for x in self.heap if not x[2].cancelled]
+            self.cancelled = 0
+            heapq.heapify(self.heap)
+        self.schedule()
+
+    def pop(self):
+        _, _, timer = heapq.heappop(self.heap)
+        timer.timers = None
+        if timer.cancelled:
+            self.cancelled -= 1
+        return timer
+
+    def __len__(self):
+        return len(self.heap)
+
+
+def resolve(future, result):
+    if not future.done():
+        future.set_result(result)
@@ -0,0 +1,80 @@
+import asyncio
+import re
+
+import websockets
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+class StreamConnection:
+    def __init__(self, reader, writer, max_size=2 ** 20):
+        self.reader = reader
+        self.writer = writer
+        self.max_size = max_size
+        self.closed = False
+        self.lock = None
+
+    async def send(self, message):
+        if isinstance(message, str):
+            message = message.encode()
+        if self.closed:
+            raise ConnectionClosed()
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        self.writer.write(len(message).to_bytes(4, "big") + message)
+        async with self.lock:  # Concurrent drains aren't supported before python 3.10
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.closed = True
+                raise ConnectionClosed()
+
+    async def recv(self):
+        try:
+            n = int.from_bytes(await self.reader.readexactly(4), "big")
+            if self.max_size is not None and n > self.max_size:
+                await self.close()
+                raise ConnectionClosed("frame of %d bytes exceeds max_size" % n)
+            return await self.reader.readexactly(n)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.closed = True
+            raise ConnectionClosed()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionClosed:
+            raise StopAsyncIteration
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+async def connect(url, max_size=2 ** 20, **kwargs):
+    if url.startswith("unix://"):
+        return StreamConnection(*(await asyncio.open_unix_connection(url[len("unix://"):])), max_size)
+    if url.startswith("tcp://"):
+        host, port = re.match(r"tcp://([^:/]+):?(\d*)", url).groups()
+        return StreamConnection(*(await asyncio.open_connection(host, int(port or 8776))), max_size)
+    return await websockets.connect(url, max_size=max_size, **kwargs)
+
+
+async def serve(handler, host, port, transport="websocket", max_size=2 ** 20, path=None, **kwargs):
+    def handle_stream(reader, writer):
+        return handler(StreamConnection(reader, writer, max_size), None)
+
+    if path is not None:
+        return await asyncio.start_unix_server(handle_stream, path, **kwargs)
+    if transport == "tcp":
+        return await asyncio.start_server(handle_stream, host, port, **kwargs)
+    if "compression" not in kwargs:
+        kwargs["compression"] = None
+    return await websockets.serve(handler, host, port, max_size=max_size, **kwargs)
@@ -0,0 +1,376 @@
+from telekinesis import Broker, Telekinesis, memoize, Connection, Session, Cache, Executor, State, Route
+from telekinesis.cryptography import Token
+from telekinesis.microbenchmark import run_microbenchmarks
+import asyncio
+import os
+import time
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def event_loop():
+    yield asyncio.get_event_loop()
+
+
+async def test_multiplexing():
+    await Broker().serve(port=8780)
+    conn_0 = await Connection(Session(), "ws://localhost:8780")
+    conn_1 = await Connection(Session(), "ws://localhost:8780")
+
+    async def slow_echo(x):
+        await asyncio.sleep(0.01)
+        return x
+
+    route = Telekinesis(slow_echo, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    echo = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)  # The peer echoes request ids
+
+    assert conn_0.session.session_key.public_serial() in conn_1.session.dispatcher.multiplexed_sessions
+    assert await asyncio.wait_for(echo(-1), 4) == -1
+    n_channels = len(conn_1.session.channels)
+
+    assert list(range(20)) == await asyncio.wait_for(asyncio.gather(*(echo(i) for i in range(20))), 10)
+    assert len(conn_1.session.channels) == n_channels
+
+    dispatcher = conn_1.session.dispatcher
+    listen_task, channel_id = dispatcher.listen_task, dispatcher.listener.channel.channel_key.public_serial()
+    await asyncio.wait_for(echo._close(), 4)
+    await asyncio.sleep(0)
+    assert listen_task.done() and dispatcher.listener is None and channel_id not in conn_1.session.channels
+    assert not any(token.asset == channel_id for token, _ in conn_1.session.issued_tokens.values())
+
+
+async def test_repr_options():
+    await Broker().serve(port=8781)
+    conn_0 = await Connection(Session(), "ws://localhost:8781")
+    conn_1 = await Connection(Session(), "ws://localhost:8781")
+
+    class Big:
+        def __init__(self):
+            self.n_reprs = 0
+            self.items = []
+
+        def append(self, x):
+            self.items.append(x)
+
+        def __repr__(self):
+            self.n_reprs += 1
+            return "Big" + "!" * 100
+
+    big = Big()
+    route = Telekinesis(big, conn_0.session, lazy_repr=True, max_repr_len=10)._delegate(
+        conn_1.session.session_key.public_serial()
+    )
+    tk_big = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    await asyncio.wait_for(tk_big.append(1), 4)
+    await asyncio.wait_for(tk_big.items._execute(), 4)
+
+    assert big.n_reprs == 0
+    assert await asyncio.wait_for(tk_big._fetch_repr(), 4) == "Big!!!!!!!"
+    assert big.n_reprs == 1
+
+    route = Telekinesis(Big(), conn_0.session, max_repr_len=5)._delegate(conn_1.session.session_key.public_serial())
+    tk_big = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    last_change = tk_big._state.last_change
+    await asyncio.wait_for(tk_big.items._execute(), 4)  # Reading attributes doesn't create a new version
+
+    assert tk_big._state.last_change == last_change
+    await asyncio.wait_for(tk_big.append(1), 4)
+    assert tk_big._state.last_change > last_change
+    assert tk_big._state.repr == "Big!!"
+
+
+async def test_cache():
+    await Broker().serve(port=8782)
+    conn_0 = await Connection(Session(), "ws://localhost:8782")
+    conn_1 = await Connection(Session(), "ws://localhost:8782")
+
+    class Config:
+        def __init__(self):
+            self.n_lookups = 0
+            self.value = 1
+
+        def lookup(self, key):
+            self.n_lookups += 1
+            return key * self.value
+
+        def set_value(self, value):
+            self.value = value
+
+    config = Config()
+    route = Telekinesis(config, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    tk_config = await asyncio.wait_for(Telekinesis(route, conn_1.session, cache=Cache(methods=["lookup"])), 4)
+
+    assert ["a", "a", 1] == [await asyncio.wait_for(x, 4) for x in [
+        tk_config.lookup("a"), tk_config.lookup("a"), tk_config.value._execute()
+    ]]
+    assert config.n_lookups == 1
+
+    config.value = 2  # Changes made behind Telekinesis' back are only seen once a newer version is reported
+    assert await asyncio.wait_for(tk_config.value._execute(), 4) == 1
+
+    await asyncio.wait_for(tk_config.set_value(3), 4)
+    assert await asyncio.wait_for(tk_config.value._execute(), 4) == 3
+
+
+async def test_executor():
+    await Broker().serve(port=8783)
+    conn_0 = await Connection(Session(), "ws://localhost:8783")
+    conn_1 = await Connection(Session(), "ws://localhost:8783")
+
+    def blocking(x):
+        time.sleep(0.5)
+        return x
+
+    async def awaited(x):
+        return x
+
+    executor = Executor("thread", 4)
+    route = Telekinesis(blocking, conn_0.session, executor=executor)._delegate(conn_1.session.session_key.public_serial())
+    tk_blocking = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    route = Telekinesis(awaited, conn_0.session, executor=executor)._delegate(conn_1.session.session_key.public_serial())
+    tk_awaited = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+
+    t = time.time()
+    assert [0, 1, 2, 3] == await asyncio.wait_for(asyncio.gather(*(tk_blocking(i) for i in range(4))), 4)
+    assert time.time() - t < 1.5  # The calls ran side by side without blocking the event loop
+    assert await asyncio.wait_for(tk_awaited("a"), 4) == "a"
+    assert executor.stats["calls"] == 4 and executor.stats["pending"] == 0
+
+
+def process_id():
+    return os.getpid()
+
+
+async def test_process_executor():
+    session = Session()
+
+    class Counter:
+        def __init__(self):
+            self.n = 0
+
+        def incr(self):
+            self.n += 1
+            return self.n
+
+    executor = Executor("process", 2)
+    try:
+        counter = Counter()
+        route = Telekinesis(counter, session, executor=executor)._delegate(session.session_key.public_serial())
+        proxy = Telekinesis._from_state(State.from_object(counter), route, session)
+        assert [1, 2, 3] == [await asyncio.wait_for(proxy.incr(), 4) for _ in range(3)]
+        assert counter.n == 3 and executor.stats["calls"] == 0  # Methods run inline on the published object
+
+        route = Telekinesis(process_id, session, executor=executor)._delegate(session.session_key.public_serial())
+        proxy = Telekinesis._from_state(State.from_object(process_id), route, session)
+        assert await asyncio.wait_for(proxy(), 10) != os.getpid()
+        assert executor.stats["calls"] == 1
+    finally:
+        executor.shutdown()
+
+
+async def test_stream():
+    await Broker().serve(port=8784)
+    conn_0 = await Connection(Session(), "ws://localhost:8784")
+    conn_1 = await Connection(Session(), "ws://localhost:8784")
+
+    produced = []
+
+    class Rows:
+        def scan(self, n):
+            for i in range(n):
+                produced.append(i)
+                yield i
+
+        async def tail(self, n):
+            for i in range(n):
+                yield i
+
+    route = Telekinesis(Rows(), conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    rows = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+
+    items, progress = [], []
+    async for i in rows.scan(250):
+        if i % 100 == 0:
+            progress.append(len(produced))
+        if i == 50:  # The next batch is fetched while this one is consumed
+            await asyncio.sleep(0.5)
+            progress.append(len(produced))
+        items.append(i)
+    assert items == list(range(250)) and progress == [100, 200, 200, 250]
+    assert list(range(10)) == await asyncio.wait_for(_collect(rows.tail(10)._iterate(batch_size=3)), 10)
+
+
+async def _collect(async_iterable):
+    return [x async for x in async_iterable]
+
+
+async def test_promise_pipelining():
+    await Broker().serve(port=8785)
+    conn_0 = await Connection(Session(), "ws://localhost:8785")
+    conn_1 = await Connection(Session(), "ws://localhost:8785")
+    n_calls = []
+
+    class A:
+        def f(self, x):
+            return ("f", x)
+
+    class B:
+        def g(self, x):
+            return ("g", x)
+
+        def secret(self):
+            return "secret"
+
+    class C:
+        def h(self):
+            n_calls.append(1)
+            return "h"
+
+    receiver = conn_1.session.session_key.public_serial()
+    a, b, c = [
+        await asyncio.wait_for(Telekinesis(Telekinesis(obj, conn_0.session, mask)._delegate(receiver), conn_1.session), 4)
+        for obj, mask in [(A(), None), (B(), ["secret"]), (C(), None)]
+    ]
+
+    h = c.h()
+    assert ("f", ("g", ("h", ["h"]))) == await asyncio.wait_for(a.f(b.g((h, [h]))), 4)
+    assert len(n_calls) == 1  # Shared promises are only evaluated once
+
+    with pytest.raises(Exception, match=r".*Unauthorized.*"):  # Nested pipelines are checked against their owner's mask
+        s = b.g(None)
+        s._state.pipeline[0] = ("get", "secret")
+        await asyncio.wait_for(a.f(s), 4)
+
+
+async def test_memoize():
+    await Broker().serve(port=8786)
+    conn_0 = await Connection(Session(), "ws://localhost:8786")
+    conn_1 = await Connection(Session(), "ws://localhost:8786")
+
+    class Lookup:
+        def __init__(self):
+            self.n_calls = 0
+            self.table = {"a": 1}
+
+        @memoize(max_size=2)
+        def get(self, key):
+            self.n_calls += 1
+            return self.table.get(key)
+
+        def set(self, key, value):
+            self.table[key] = value
+
+        @memoize
+        def keys(self):
+            return list(self.table)
+
+    lookup = Lookup()
+    tk_lookup = Telekinesis(lookup, conn_0.session)
+    route = tk_lookup._delegate(conn_1.session.session_key.public_serial())
+    remote = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    last_change = remote._state.last_change
+
+    assert [1, 1, None, 1] == [await asyncio.wait_for(remote.get(k), 4) for k in "aaba"]
+    assert lookup.n_calls == 2
+    assert remote._state.last_change == last_change  # Pure calls don't create a new version
+    assert tk_lookup._cache_stats()[Lookup.get.__qualname__]["hits"] == 2
+
+    await asyncio.wait_for(remote.set("a", 2), 4)
+    assert await asyncio.wait_for(remote.get("a"), 4) == 1
+    await asyncio.wait_for(remote.get.invalidate(), 4)
+    assert await asyncio.wait_for(remote.get("a"), 4) == 2
+    await asyncio.wait_for(remote.set("a", 3), 4)
+    tk_lookup._invalidate_cache("get")
+    assert await asyncio.wait_for(remote.get("a"), 4) == 3
+
+    keys = await tk_lookup.keys()
+    keys.append("b")  # Callers don't share cached values
+    assert await tk_lookup.keys() == ["a"]
+    assert tk_lookup._cache_stats()[Lookup.keys.__qualname__]["hits"] == 1
+
+
+async def test_token_registry():
+    session = Session()
+
+    def issue(target, receiver):
+        return Token.decode(session.issue_token(target, receiver)[1][1])
+
+    root_a, root_b = issue("channel", "a"), issue("channel", "b")
+    ext_c, ext_d = issue(root_a, "c"), issue(root_a, "d")
+    ext_e = issue(ext_c, "e")
+    assert issue("channel", "a").signature == root_a.signature  # Reissued from the index
+    assert [(t.signature, p.signature) for t, p in session.issued_tokens.find(root_a.signature, "c", "extension", None)] == [
+        (ext_c.signature, root_a.signature)
+    ]
+
+    revoked = session.revoke_tokens(root_a.signature)  # Cascades to extensions, in issue order
+    assert [h[1][1] for h in revoked] == [t.signature for t in [root_a, ext_c, ext_e, ext_d]]
+    assert list(session.issued_tokens) == [root_b.signature]
+    assert not list(session.issued_tokens.find(root_a.signature, "c", "extension", None))
+
+    session.revoke_tokens("channel")
+    assert not len(session.issued_tokens) and not session.issued_tokens.index and not session.issued_tokens.children
+
+
+async def test_microbenchmarks():
+    only = ["encode", "decode", "connection_encode", "rpc_round_trip", "local_call"]
+    result = await run_microbenchmarks(number=2, repeat=1, only=only, port=8787)
+    assert set(result["results"]) == set(only)
+    assert all(x["ops_per_sec"] > 0 for x in result["results"].values())
+    with pytest.raises(OSError):  # The broker is closed
+        await asyncio.open_connection("127.0.0.1", 8787)
+
+
+async def test_local_dispatch():
+    session = Session()  # No connections, requests can only be served in process
+
+    class Counter:
+        def __init__(self):
+            self.values = [0]
+
+        def increment(self, values):
+            values.append(len(values))
+            self.values[0] += 1
+            return self.values
+
+        def secret(self):
+            return "secret"
+
+        def keep(self, obj):
+            self.kept = obj
+            return True
+
+        def scan(self, n):
+            return (i for i in range(n))
+
+        async def tail(self, n):
+            for i in range(n):
+                yield i
+
+    counter = Counter()
+    route = Telekinesis(counter, session, mask=["secret"])._delegate(session.session_key.public_serial())
+    proxy = Telekinesis._from_state(State.from_object(counter), route, session)
+
+    values = []
+    assert await asyncio.wait_for(proxy.increment(values), 4) is counter.values
+    assert values == [0]
+    with pytest.raises(Exception, match="Unauthorized"):
+        await asyncio.wait_for(proxy.secret(), 4)
+    assert [0, 1, 2] == await asyncio.wait_for(_collect(proxy.tail(3)), 4)
+    assert [0, 1, 2] == await asyncio.wait_for(_collect(proxy.scan(3)), 4)
+
+    isolated = Telekinesis(route, session, isolate=True)
+    isolated._update_state(State.from_object(counter))
+    ret = await asyncio.wait_for(isolated.increment(values), 4)
+    assert ret == [2] and ret is not counter.values
+    assert values == [0]
+
+    other = Session()
+    token = other.issue_token("channel", session.session_key.public_serial())[1][1]
+    remote = Telekinesis(Route([], other.session_key.public_serial(), "channel", [token]), session)
+    for _ in range(3):
+        assert await asyncio.wait_for(isolated.keep(remote), 4)
+    header_buffer = session.dispatcher.listener.channel.header_buffer
+    assert [h[0] for h in header_buffer] == ["token"]  # Reissued tokens aren't queued twice on the shared channel
@@ -0,0 +1,558 @@
+from telekinesis import Broker, BrokerWorkers, Session, Connection, Telekinesis, Route
+from telekinesis.cryptography import Token
+from telekinesis.benchmark import run_broker_benchmark, compare
+from telekinesis.transport import StreamConnection, ConnectionClosed, serve
+from telekinesis.client import V2_SENTINEL
+from telekinesis.timers import Timers, resolve
+from telekinesis.broker import Connection as BrokerConnection, Session as BrokerSession, Channel as BrokerChannel, Peer
+from telekinesis.broker import write_snapshot_file
+import asyncio
+import os
+import time
+import zlib
+import bson
+import pytest
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def event_loop():
+    yield asyncio.get_event_loop()
+
+
+async def test_token_validation_cache():
+    broker = Broker()
+    session = Session()
+    token = Token.decode(session.issue_token("channel", "receiver")[1][1], False)  # Issued by a session the broker can't reach
+    broker.NEGATIVE_TOKEN_CACHE_TTL = 10
+
+    def n_validations():
+        return broker.metrics.histograms[("token_validation_seconds", (("valid", False),))][2]
+
+    assert [False] * 5 == await asyncio.gather(*(broker.check_token(token) for _ in range(5)))
+    assert n_validations() == 1
+
+    t = time.time()
+    assert not await broker.check_token(token)
+    assert time.time() - t < 0.5 and n_validations() == 1
+    assert not broker.token_validations
+
+
+async def test_outbound_queues():
+    class SlowWebsocket:
+        def __init__(self):
+            self.sent = []
+            self.closed = False
+
+        async def send(self, message):
+            await asyncio.sleep(0.1)
+            self.sent.append(message)
+
+        async def close(self):
+            self.closed = True
+
+    broker = Broker(max_queue_size=2, overflow="drop_oldest")
+    await broker.serve(port=8790)
+    conn = await Connection(Session(), "ws://localhost:8790")
+    slow = broker.sessions[conn.session.session_key.public_serial()]
+    slow_connection = list(slow.connections)[0]
+    slow_connection.websocket = SlowWebsocket()
+
+    for i in range(5):
+        await slow_connection.enqueue(i)
+        await asyncio.sleep(0)
+    assert slow_connection.queue_stats()["dropped"] == 2
+    await asyncio.sleep(0.5)
+    assert slow_connection.websocket.sent == [0, 3, 4]  # The first message was already being written
+
+    writer = slow_connection.writer
+    await slow_connection.enqueue(5)
+    await asyncio.sleep(0)
+    await slow_connection.stop_writer()
+    await asyncio.sleep(0.2)
+    assert writer.cancelled() and slow_connection.outbox is None
+    assert slow_connection.websocket.sent == [0, 3, 4]
+
+    slow_connection.overflow = "disconnect"
+    for i in range(4):
+        await slow_connection.enqueue(i)
+    assert slow_connection.websocket.closed
+    assert [4] == [x["dropped"] for x in broker.queue_stats() if x["session"] == slow.session_id]
+
+
+async def test_dispatch():
+    connection = BrokerConnection(None, max_parallel=2, ordered=True)
+    processed = []
+    running = []
+
+    async def handler(key, i):
+        running.append(1)
+        assert len(running) <= 2
+        await asyncio.sleep(0.05 if i % 2 else 0.01)
+        processed.append((key, i))
+        running.pop()
+
+    for i in range(6):
+        for key in "ab":
+            connection.dispatch(handler, key, i, key=key)
+    await asyncio.sleep(0.5)
+
+    assert [i for key, i in processed if key == "a"] == list(range(6))
+    assert [i for key, i in processed if key == "b"] == list(range(6))
+    assert connection.dispatch_stats["processed"] == 12 and not connection.tasks and not connection.ordered_tasks
+
+
+async def test_peer_token_approvals():
+    broker = Broker()
+    session = Session()
+    session.connections.add(type("BrokerConnection", (), {"broker_id": broker.broker_key.public_serial(), "t_offset": 0}))
+    enc_token = session.issue_token("channel", "receiver")[1][1]
+    token = Token.decode(enc_token)
+
+    issuer = broker.sessions[token.issuer] = BrokerSession(token.issuer)
+    issuer.active_tokens[token.signature] = token
+    peer = Peer(None, broker)
+    broker.sessions["peer"] = BrokerSession("peer")
+    broker.sessions["peer"].broker_connections[peer] = peer
+    sent = []
+
+    async def send(header):
+        sent.append(header)
+
+    peer.send = send
+
+    assert [("token", ("approve", enc_token))] == broker.token_approvals(peer, [enc_token, enc_token])
+    assert [] == broker.token_approvals(peer, [enc_token])  # Approvals are only sent once per peer
+
+    await broker.revoke_peer_approvals(token.signature)
+    assert sent == [(("token", ("revoke", token.signature)),)]
+    assert [("token", ("approve", enc_token))] == broker.token_approvals(peer, [enc_token])
+
+
+async def test_workers():
+    workers = BrokerWorkers(2, port=8791)
+    workers.start()
+    try:
+        await asyncio.sleep(3)
+        connections = {}
+        for _ in range(20):  # The kernel spreads connections across the workers sharing the port
+            conn = await Connection(Session(), "ws://localhost:8791")
+            connections.setdefault(conn.broker_id, conn)
+            if len(connections) == 2:
+                break
+        assert len(connections) == 2
+        conn_0, conn_1 = connections.values()
+
+        route = Telekinesis(lambda x: x + 1, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+        add_one = await asyncio.wait_for(Telekinesis(route, conn_1.session), 10)  # Forwarded between workers
+        assert await asyncio.wait_for(add_one(1), 10) == 2
+    finally:
+        workers.close()
+
+
+async def test_worker_reconnect():
+    workers = BrokerWorkers(2, port=8807)
+    workers.start()
+    try:
+        await asyncio.sleep(3)
+        urls = ["tcp://127.0.0.1:%d" % p for p in workers.peer_ports]  # Each worker can also be reached on its own port
+        conn_0 = await Connection(Session(), urls[0])
+        conn_1 = await Connection(Session(), urls[0])
+        broker_ids = [conn_0.broker_id, (await Connection(Session(), urls[1])).broker_id]
+
+        route = Telekinesis(lambda x: x + 1, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+        add_one = await asyncio.wait_for(Telekinesis(route, conn_1.session), 10)
+        assert await asyncio.wait_for(add_one(1), 10) == 2
+
+        conn_0.url = urls[1]  # As if the kernel handed the reconnection to the other worker
+        await conn_0.websocket.close()
+        await asyncio.sleep(2)
+        assert conn_0.broker_id == broker_ids[1]
+        assert await asyncio.wait_for(add_one(2), 10) == 3  # The first worker forwards instead of keeping a stale copy
+
+        workers.processes[0].terminate()  # The supervisor restarts the worker with the same identity
+        await asyncio.sleep(5)
+        assert conn_1.broker_id == broker_ids[0]
+        assert await asyncio.wait_for(add_one(3), 10) == 4
+    finally:
+        workers.close()
+
+
+async def test_no_repeat():
+    broker = Broker()
+    ahead = b"s" * 64 + (int(time.time()) + 10).to_bytes(4, "big") + b"frame"  # Stamped by a broker 10 sec ahead of us
+    assert not broker.check_no_repeat(ahead)
+    assert broker.check_no_repeat(ahead, False)  # Peer links only drop duplicates
+    assert not broker.check_no_repeat(ahead, False)
+
+
+async def test_routing_table():
+    broker = Broker()
+    peers = {}
+    for broker_id in ["peer_0", "peer_1"]:
+        peers[broker_id] = Peer(None, broker)
+        broker.sessions[broker_id] = BrokerSession(broker_id)
+        broker.sessions[broker_id].broker_connections[peers[broker_id]] = peers[broker_id]
+
+    destination = Route(["peer_0", "peer_1"], "session", "channel")
+    assert ("peer_0", peers["peer_0"]) == broker.next_hop(destination, "client")
+
+    client = BrokerConnection(None)
+    client.session = broker.sessions["peer_1"]
+    broker.handle_route(client, add=["session"])  # Ignored, the announcement didn't come over a peer link
+    assert not broker.routes
+
+    peers["peer_1"].session = broker.sessions["peer_1"]
+    broker.handle_route(peers["peer_1"], add=["session"])
+    assert ("peer_1", peers["peer_1"]) == broker.next_hop(destination, "client")
+    assert ("peer_0", peers["peer_0"]) == broker.next_hop(destination, "peer_1")  # Never sent back where it came from
+
+    broker.handle_route(peers["peer_1"], reset=True)
+    assert not broker.routes
+
+    peers["peer_1"].websocket = type("Websocket", (), {"closed": False})()
+    assert ("peer_1", peers["peer_1"]) == broker.next_hop(destination, "client")  # peer_0's link is down
+
+    class SlowPeer:
+        def __init__(self):
+            self.sent = []
+
+        def is_connected(self):
+            return True
+
+        async def send(self, header):
+            await asyncio.sleep(0 if self.sent else 0.1)
+            self.sent.append(header[0][1])
+
+    slow = SlowPeer()
+    broker.sessions["peer_0"].broker_connections = {slow: slow}
+    broker.sessions.pop("peer_1")
+    broker.announce_routes(add=["session"])
+    broker.announce_routes(remove=["session"])
+    await asyncio.sleep(0.3)
+    assert slow.sent == [{"add": ["session"], "remove": ()}, {"add": (), "remove": ["session"]}]
+
+
+async def test_metrics():
+    broker = await (await Broker().serve(port=8794)).serve_metrics(port=8795)
+    broker.TICKET_TTL = 0.2
+    conn_0 = await Connection(Session(), "ws://localhost:8794")
+    conn_1 = await Connection(Session(), "ws://localhost:8794")
+
+    route = Telekinesis(lambda x: x, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    echo = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    assert await asyncio.wait_for(echo(1), 4) == 1
+
+    metrics = broker.metrics.to_dict()
+    assert sum(v for labels, v in metrics["messages_total"]) >= 4
+    assert all(set(labels) == {"session"} for labels, v in metrics["messages_total"] + metrics["bytes_total"])
+    assert sum(v["count"] for labels, v in metrics["forward_latency_seconds"]) >= 4
+    assert [({}, 2)] == metrics["sessions"]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", 8795)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = (await reader.read()).decode()
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert "# TYPE telekinesis_broker_messages_total counter" in response
+    assert 'telekinesis_broker_forward_latency_seconds_bucket{path="local",le="+Inf"}' in response
+    broker.metrics.close()
+
+    session_id = conn_0.session.session_key.public_serial()
+    assert session_id in [labels["session"] for labels, v in broker.metrics.to_dict()["messages_total"]]
+    conn_0.listener.cancel()
+    await conn_0.websocket.close()
+    await asyncio.sleep(0.5)  # Disconnected and its ticket expired, so the session is released outside of GC
+    assert session_id not in broker.sessions
+    broker.collect_garbage()
+    assert session_id not in [labels["session"] for labels, v in broker.metrics.to_dict()["messages_total"]]
+
+
+async def test_benchmark():
+    result = await run_broker_benchmark(n_brokers=2, n_sessions=2, duration=0.5, port=8796)
+    assert result["messages"] > 0 and result["errors"] == 0
+    assert result["latency"]["p50"] <= result["latency"]["p999"]
+    assert compare(result, result)["throughput"]["ratio"] == 1
+    assert len(result["brokers"]) == 2 and all(b["cpu_seconds"] > 0 for b in result["brokers"])
+
+
+async def test_tcp_peering():
+    broker_0 = await Broker().serve(port=8798)
+    await broker_0.serve(port=8799, transport="tcp")
+    broker_1 = await Broker().serve(port=8800)
+    await broker_1.add_broker("tcp://localhost:8799")
+    conn_0 = await Connection(Session(), "ws://localhost:8798")
+    conn_1 = await Connection(Session(), "ws://localhost:8800")
+
+    peer = list(broker_1.sessions[broker_0.broker_key.public_serial()].broker_connections.values())[0]
+    assert isinstance(peer.websocket, StreamConnection)
+
+    route = Telekinesis(lambda x: x * 2, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    double = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    assert await asyncio.wait_for(double("a" * 2 ** 20), 10) == "a" * 2 ** 21
+
+
+async def test_peer_revocation():
+    broker_0 = await Broker().serve(port=8810)
+    broker_1 = await Broker().serve(port=8811)
+    await broker_1.add_broker("ws://localhost:8810")
+    conn = await Connection(Session(), "ws://localhost:8811")
+    await asyncio.sleep(0.2)
+
+    token_header = conn.session.issue_token("channel", "receiver")
+    token = Token.decode(token_header[1][1])
+    await conn.session.send([token_header])
+    await asyncio.sleep(0.2)
+    assert await asyncio.wait_for(broker_0.check_token(token), 4)  # Validated by broker_1, the issuer's broker
+    assert token.signature in broker_0.token_cache
+
+    await conn.session.send(conn.session.revoke_tokens("channel"))
+    await asyncio.sleep(0.2)
+    assert token.signature not in broker_0.token_cache
+    assert token.signature not in broker_0.sessions[broker_1.broker_key.public_serial()].cached_tokens
+
+
+async def test_stream_max_size():
+    received = asyncio.get_event_loop().create_future()
+
+    async def handler(connection, _):
+        frames = [await connection.recv()]
+        try:
+            await connection.recv()
+        except ConnectionClosed:
+            frames.append(connection.closed)
+        received.set_result(frames)
+
+    server = await serve(handler, "127.0.0.1", 8805, "tcp", max_size=16)
+    reader, writer = await asyncio.open_connection("127.0.0.1", 8805)
+    writer.write((4).to_bytes(4, "big") + b"abcd" + (17).to_bytes(4, "big") + b"a" * 17)
+    assert await asyncio.wait_for(received, 4) == [b"abcd", True]
+    assert await asyncio.wait_for(reader.read(), 4) == b""  # The oversized frame closed the connection
+    writer.close()
+    server.close()
+
+
+async def test_unix_socket(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    broker = await Broker().serve(port=8801)
+    await broker.serve(path=path)
+    conn_0 = await Connection(Session(), "unix://" + path)
+    conn_1 = await Connection(Session(), "ws://localhost:8801")
+    assert isinstance(conn_0.websocket, StreamConnection)
+
+    route = Telekinesis(lambda x: x + 1, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    add_one = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    assert await asyncio.wait_for(add_one(1), 4) == 2
+
+    await broker.close(path=path)
+    assert list(broker.servers) == [("127.0.0.1", 8801, None)]
+    await broker.close()
+
+
+async def test_session_resumption():
+    broker = await Broker().serve(port=8802)
+    broker.TICKET_TTL = 0.5
+    conn_0 = await Connection(Session(), "ws://localhost:8802")
+    conn_1 = await Connection(Session(), "ws://localhost:8802")
+    session_id = conn_0.session.session_key.public_serial()
+    assert conn_0.ticket and not broker.metrics.counters.get(("connections_total", (("resumed", True),)))
+
+    route = Telekinesis(lambda x: x + 1, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    add_one = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    channels = set(broker.sessions[session_id].channels)
+
+    await conn_0.websocket.close()
+    await asyncio.sleep(0.1)
+    assert set(broker.sessions[session_id].channels) == channels  # Kept for the reconnect
+
+    assert await asyncio.wait_for(add_one(1), 4) == 2
+    assert broker.metrics.counters[("connections_total", (("resumed", True),))] == 1
+    assert all(channel.connections for channel in broker.sessions[session_id].channels.values())
+
+    conn_0.listener.cancel()
+    await conn_0.websocket.close()
+    await asyncio.sleep(1)
+    assert session_id not in broker.sessions and not broker.tickets.get(conn_0.ticket["id"])
+
+
+async def test_send_while_disconnected():
+    broker = await Broker().serve(port=8806)
+    conn_0 = await Connection(Session(), "ws://localhost:8806")
+    conn_1 = await Connection(Session(), "ws://localhost:8806")
+    session = broker.sessions[conn_0.session.session_key.public_serial()]
+
+    route = Telekinesis(lambda x: x + 1, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    add_one = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+
+    conn_0.listener.cancel()
+    await conn_0.websocket.close()
+    await asyncio.sleep(0.1)
+    assert not session.connections
+
+    call = asyncio.ensure_future(add_one(1))
+    await asyncio.sleep(0.5)
+    assert not call.done() and session.expecting_channels  # The broker holds the send for the retained channel
+
+    await conn_0.reconnect()
+    assert await asyncio.wait_for(call, 4) == 2
+    assert broker.metrics.counters[("connections_total", (("resumed", True),))] == 1
+
+
+async def test_send_to_retained_channel():
+    broker = Broker()
+    owner = broker.sessions["owner"] = BrokerSession("owner")
+    owner.channels["channel"] = BrokerChannel(owner, "channel", True)  # Kept for an owner that never reconnects
+    sender = BrokerConnection(None)
+    sender.session = BrokerSession("sender")
+
+    source, destination = Route([], "sender", "reply").to_dict(), Route([], "owner", "channel").to_dict()
+    await asyncio.wait_for(broker.handle_send(sender, b"\x00" * 128, source, destination), 4)
+    assert broker.metrics.counters[("dropped_messages_total", ())] == 1
+    assert ("delivered_messages_total", (("session", "owner"),)) not in broker.metrics.counters
+
+
+async def test_replay_batches():
+    broker = await Broker().serve(port=8803)
+    session = Session()
+    receivers = [Session().session_key.public_serial() for _ in range(3)]
+    for i in range(300):  # More than the 64 KiB a v1 header can hold
+        session.issue_token("channel%d" % i, receivers[i % 3])
+
+    conn = await asyncio.wait_for(Connection(session, "ws://localhost:8803"), 10)
+    assert conn.framing == 2
+    broker_session = broker.sessions[session.session_key.public_serial()]
+    for _ in range(50):
+        if len(broker_session.active_tokens) == 300:
+            break
+        await asyncio.sleep(0.1)
+    assert len(broker_session.active_tokens) == 300
+    broker_connection = list(broker_session.connections)[0]
+    assert broker_connection.dispatch_stats["received"] > 1  # The replay was split into several messages
+
+    big_header = [("listen", {"session": "x" * 2 ** 16, "channel": "", "brokers": []})]
+    s, mm = conn.encode(big_header, b"", None, 0)
+    assert mm[4:6] == V2_SENTINEL and broker.decode_header(s + mm) == [list(big_header[0])]
+
+    conn.framing = 1
+    with pytest.raises(Exception, match="Frame too large"):
+        conn.encode(big_header, b"", None, 0)
+
+    v1_connection = BrokerConnection(None)
+    await v1_connection.enqueue(s + mm)
+    assert v1_connection.stats["dropped"] == 1 and not v1_connection.outbox.qsize()
+
+
+async def test_snapshot(tmp_path):
+    key_file, snapshot_file = str(tmp_path / "broker.pem"), str(tmp_path / "broker.snapshot")
+    broker = await Broker(key_file, snapshot_file=snapshot_file, snapshot_interval=60).serve(port=8804)
+    conn_0 = await Connection(Session(), "ws://localhost:8804")
+    conn_1 = await Connection(Session(), "ws://localhost:8804")
+    session_id = conn_0.session.session_key.public_serial()
+
+    route = Telekinesis(lambda x: x + 1, conn_0.session)._delegate(conn_1.session.session_key.public_serial())
+    add_one = await asyncio.wait_for(Telekinesis(route, conn_1.session), 4)
+    headers = [conn_0.session.issue_token(asset, "receiver") for asset in ["asset_0", "asset_1"]]
+    signatures = [enc_token.split(".")[0] for _, (_, enc_token, _) in headers]
+    await conn_0.send(headers)
+    await asyncio.sleep(0.1)
+    channels = set(broker.sessions[session_id].channels)
+
+    await broker.write_snapshot()
+    await conn_0.send(conn_0.session.revoke_tokens("asset_0"))  # Only in the revocation journal
+    await asyncio.sleep(0.1)
+    broker.snapshot_task.cancel()
+    await broker.close()
+    assert all(os.stat(path).st_mode & 0o777 == 0o600 for path in [snapshot_file, snapshot_file + ".revoked"])
+
+    with open(snapshot_file, "rb") as f:
+        state = bson.loads(zlib.decompress(f.read()))
+    assert state["tickets"] and not {t["secret"] for t in state["tickets"]} & {t["secret"] for t in broker.tickets.values()}
+    enc_token = broker.sessions[session_id].active_tokens[signatures[1]].encode()
+    state["sessions"][session_id]["active_tokens"].append(enc_token.replace("asset_1", "asset_2"))  # Fails verification
+    write_snapshot_file(snapshot_file, state)
+
+    restarted = Broker(key_file, snapshot_file=snapshot_file)
+    restored = restarted.sessions[session_id]
+    assert set(restored.channels) == channels
+    assert signatures[1] in restored.active_tokens and signatures[0] not in restored.active_tokens
+    assert restored.active_tokens[signatures[1]].asset == "asset_1"
+
+    await restarted.serve(port=8804)
+    assert await asyncio.wait_for(add_one(1), 10) == 2
+    assert restarted.metrics.counters[("connections_total", (("resumed", True),))] == 2
+    restarted.snapshot_task.cancel()
+
+
+async def test_garbage_collection():
+    broker = Broker(idle_ttl=0)
+    session = Session(token_ttl=0.2)
+    enc_token = session.issue_token("channel", "receiver")[1][1]
+    token = Token.decode(enc_token)
+
+    for session_id in [session.session_key.public_serial(), "resumable"]:
+        broker_session = broker.sessions[session_id] = BrokerSession(session_id)
+        broker_session.active_tokens[token.signature] = token
+        broker_session.channels["channel"] = BrokerChannel(broker_session, "channel", False)
+    broker.tickets["ticket"] = {"session_id": "resumable", "connection": None, "expires": time.time() + 10, "channels": []}
+    assert await broker.check_token(token)
+    assert broker.table_sizes()["active_tokens"] == 2
+
+    peer = Peer(None, broker)
+    peer.t_offset = -5  # The peer's clock is 5 sec ahead of ours
+    broker.sessions["peer"] = BrokerSession("peer")
+    broker.sessions["peer"].broker_connections[peer] = peer
+    peer.approved_tokens.update(old=("old", time.time() - 1), new=("new", time.time() + 10))
+    remote_token = Token("issuer", ["peer"], "receiver", "channel", "root", valid_until=time.time() + 2)
+    assert broker.clock_offset(remote_token) == -5 and not await broker.check_token(remote_token)
+
+    await asyncio.sleep(0.3)
+    assert not await broker.check_token(token)
+    assert session.issue_token("channel", "receiver")[1][1] != enc_token
+    assert len(session.issued_tokens) == 1  # The expired token was collected
+
+    broker.metrics.inc("messages_total", session=session.session_key.public_serial())
+    broker.metrics.inc("messages_total", session="resumable")
+    assert broker.collect_garbage()["sessions"] == 1
+    assert [({"session": "resumable"}, 1)] == broker.metrics.to_dict()["messages_total"]  # Series of evicted sessions go too
+    assert list(broker.sessions) == ["resumable", "peer"] and not broker.sessions["resumable"].active_tokens
+    assert broker.table_sizes()["active_tokens"] == 0
+    assert list(peer.approved_tokens) == ["new"] and broker.table_sizes()["approved_tokens"] == 1
+    assert broker.metrics.counters[("gc_evictions_total", (("table", "active_tokens"),))] == 2
+
+
+async def test_timers():
+    timers, fired = Timers(), []
+    assert Timers.get() is Timers.get()
+    timers.call_later(0.2, fired.append, "b")
+    timers.call_later(0.1, fired.append, "a")
+    timers.call_later(0.15, fired.append, "cancelled").cancel()
+    assert timers.cancelled == 1
+    await asyncio.sleep(0.3)
+    assert fired == ["a", "b"] and timers.cancelled == 0
+
+    session = BrokerSession("session")
+    token = Token.decode(Session().issue_token("channel", "receiver")[1][1])
+    future = asyncio.get_event_loop().create_future()
+    session.expect_token(token, future)
+    session.approve_token(token)  # Approvals resolve the validation and replace the expiry of cached tokens
+    session.approve_token(token)
+    assert future.result() and not session.expecting_tokens
+    assert len(session.cached_token_timers) == 1 and token.signature in session.cached_tokens
+    session.cached_token_timers[token.signature].cancel()
+
+    assert await asyncio.wait_for(session.expect_channel("channel"), 4) is None
+    assert not session.expecting_channels
+
+
+async def test_expect_channel_waiters():
+    session = BrokerSession("session")
+    waiters = [asyncio.ensure_future(session.expect_channel("channel")) for _ in range(3)]
+    await asyncio.sleep(0)
+    waiters[0].cancel()
+    await asyncio.sleep(0)
+    assert "channel" in session.expecting_channels
+
+    channel = session.channels["channel"] = BrokerChannel(session, "channel", False)
+    resolve(session.expecting_channels["channel"], True)
+    assert await asyncio.wait_for(asyncio.gather(*waiters[1:]), 1) == [channel, channel]
+    assert waiters[0].cancelled() and not session.expecting_channels